@@ -0,0 +1,376 @@
+"""Run the batch scripts without a browser, against the HTTP API of one or more webui instances started with --api.
+
+    python batchscripts_cli.py frominfo infotexts.txt --backend http://127.0.0.1:7860 --out outputs
+    python batchscripts_cli.py A images.txt --backend http://gpu1:7860 --backend http://gpu2:7860 --override Seed \
+        --set seed=-1
+
+Inputs are read and parsed like the scripts do (a list of images for A, "path" batch_size lines for B, infotexts for
+frominfo). Each backend takes whole checkpoint groups and keeps a group until it runs out, through a small pool of
+keep-alive connections; failed requests are retried with exponential backoff. Images are written to the output
+folder as they come back, with a manifest linking them to their source entry.
+"""
+import argparse
+import asyncio
+import base64
+import http.client
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import scripts.script_common as sc  # noqa: E402
+
+manifest_filename = "batchscripts_cli_manifest.jsonl"
+retry_statuses = {429, 500, 502, 503, 504}
+
+
+class TransientError(Exception):
+    pass
+
+
+class Backend:
+    """A webui instance: a pool of keep-alive connections to its API, the checkpoints it knows and the checkpoint group
+    it is working on."""
+
+    def __init__(self, url, connections=2, timeout=600):
+        parts = urllib.parse.urlsplit(url if "://" in url else "http://" + url)
+        self.url = url
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip("/")
+        self.connections = connections
+        self.timeout = timeout
+        self.pool = queue.LifoQueue()
+        self.checkpoints = {}
+        self.model = None
+        self.switches = 0
+        self.jobs = 0
+        self.retries = 0
+
+    def connect(self):
+        connection_class = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+        return connection_class(self.netloc, timeout=self.timeout)
+
+    def request(self, method, path, payload=None):
+        # Blocking, runs in the I/O threads. Connection errors and overloaded server answers raise TransientError.
+        try:
+            connection = self.pool.get_nowait()
+        except queue.Empty:
+            connection = self.connect()
+        try:
+            body = None if payload is None else json.dumps(payload).encode("utf8")
+            connection.request(method, self.prefix + path, body=body, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            connection.close()
+            raise TransientError(f"{self.url}: {e}") from e
+        self.pool.put(connection)
+
+        if response.status in retry_statuses:
+            raise TransientError(f"{self.url}: HTTP {response.status}")
+        if response.status >= 400:
+            raise RuntimeError(f"{self.url}: HTTP {response.status} {data[:200].decode('utf8', errors='ignore')}")
+        return json.loads(data)
+
+    def set_checkpoints(self, models):
+        # models as listed by /sdapi/v1/sd-models
+        for model in models:
+            for alias in (model.get('title'), model.get('model_name'), model.get('hash'), model.get('sha256')):
+                if alias:
+                    self.checkpoints[alias.lower()] = model['title']
+
+    def resolve(self, model):
+        # Title of the checkpoint named by a "Model hash" value: a title, name, short hash or sha256 (prefix)
+        if model is None:
+            return None
+        model = model.lower()
+        if model in self.checkpoints:
+            return self.checkpoints[model]
+        return next((title for alias, title in self.checkpoints.items() if len(alias) == 64 and
+                     alias.startswith(model)), None)
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get_nowait().close()
+
+
+class Scheduler:
+    """Pending jobs by checkpoint, filled by the planning thread. A backend keeps taking the jobs of its checkpoint,
+    jobs without a checkpoint fill the gaps, and when its group is done it switches to the largest group no other
+    backend is working on, once lookahead jobs are pending or planning is over."""
+
+    def __init__(self, loop, backends, lookahead=64, max_pending=4096):
+        self.loop = loop
+        self.backends = backends
+        self.lookahead = lookahead
+        self.pending = {}
+        self.count = 0
+        self.planned = 0
+        self.closed = False
+        self.stopped = False
+        self.wakeup = asyncio.Event()
+        self.room = threading.Semaphore(max_pending)  # backpressure on the planning thread
+
+    def add(self, job):
+        # Called from the planning thread, returns False once the run is over
+        while not self.room.acquire(timeout=0.5):
+            if self.stopped:
+                return False
+        self.loop.call_soon_threadsafe(self._add, job)
+        return not self.stopped
+
+    def _add(self, job):
+        self.pending.setdefault(job.args.get('sd_model_hash'), deque()).append(job)
+        self.count += 1
+        self.planned += 1
+        self.wakeup.set()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        self.closed = True
+        self.wakeup.set()
+
+    def _pop(self, model):
+        job = self.pending[model].popleft()
+        if not self.pending[model]:
+            del self.pending[model]
+        self.count -= 1
+        self.room.release()
+        return job
+
+    async def take(self, backend):
+        # The next job for backend, None when there are none left it can run. Jobs using a checkpoint no backend
+        # knows are handed out as they come, for the worker to report them.
+        while True:
+            if backend.model in self.pending:
+                return self._pop(backend.model)
+            if None in self.pending:
+                return self._pop(None)
+            for model in self.pending:
+                if all(other.resolve(model) is None for other in self.backends):
+                    return self._pop(model)
+
+            usable = [model for model in self.pending if backend.resolve(model) is not None]
+            if usable and (self.closed or self.count >= self.lookahead):
+                busy = {other.model for other in self.backends if other is not backend}
+                free = [model for model in usable if model not in busy] or usable
+                backend.model = max(free, key=lambda model: len(self.pending[model]))
+                backend.switches += 1
+                return self._pop(backend.model)
+            if self.closed and not usable:
+                return None
+            self.wakeup.clear()
+            await self.wakeup.wait()
+
+
+class OutputWriter:
+    """Writes the images of the API responses and the manifest linking them to their source entries."""
+
+    def __init__(self, outdir, journal):
+        os.makedirs(outdir, exist_ok=True)
+        self.outdir = outdir
+        self.journal = journal
+        self.lock = threading.Lock()
+        self.counter = len(os.listdir(outdir))
+        self.images = 0
+        self.manifest = open(os.path.join(outdir, manifest_filename), "a", encoding="utf8")
+
+    def write(self, job, backend, checkpoint, response):
+        info = json.loads(response.get('info') or "{}")
+        seeds = info.get('all_seeds') or [job.args.get('seed')]
+        files = []
+        for n, image in enumerate(response.get('images') or []):
+            with self.lock:
+                self.counter += 1
+                number = self.counter
+            seed = seeds[n] if n < len(seeds) else seeds[-1]
+            path = os.path.join(self.outdir, f"{number:05}-{seed}.png")
+            with open(path, "wb") as f:
+                f.write(base64.b64decode(image.split(",", 1)[-1]))
+            files.append(path)
+
+        with self.lock:
+            self.images += len(files)
+            self.manifest.write(json.dumps({"source": job.source, "backend": backend.url, "checkpoint": checkpoint,
+                                            "seeds": seeds, "files": files}, default=str) + "\n")
+            self.manifest.flush()
+        self.journal.complete(job.ids)
+
+    def close(self):
+        self.manifest.close()
+
+
+def parse_setting(text):
+    # --set key=value, converted like the infotext values when key is one of the known parameters
+    key, _, value = text.partition("=")
+    converter = sc.prompt_tags.get(key)
+    if converter is not None:
+        return key, converter(value)
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def job_payload(job, checkpoint, defaults):
+    # txt2img API request of a Job: the settings the API does not take go to override_settings
+    payload = dict(defaults)
+    payload.update(job.args)
+    payload.pop('sd_model_hash', None)
+    payload.pop('mask_blur', None)
+    override_settings = dict(job.override_settings)
+    face_restoration_model = payload.pop('face_restoration_model', None)
+    if face_restoration_model:
+        override_settings['face_restoration_model'] = face_restoration_model
+    if checkpoint is not None:
+        override_settings['sd_model_checkpoint'] = checkpoint
+    payload.update(override_settings=override_settings, override_settings_restore_afterwards=False,
+                   do_not_save_grid=True, save_images=False, send_images=True)
+    return payload
+
+
+async def call(backend, method, path, payload, io_pool, retries, backoff):
+    # backend.request in the I/O threads, retried with exponential backoff and jitter on transient errors
+    loop = asyncio.get_running_loop()
+    for attempt in range(retries + 1):
+        try:
+            return await loop.run_in_executor(io_pool, backend.request, method, path, payload)
+        except TransientError as e:
+            if attempt == retries:
+                raise
+            backend.retries += 1
+            delay = backoff * 2 ** attempt * random.uniform(0.5, 1.0)
+            print(f"{e}, retrying in {delay:.1f} s")
+            await asyncio.sleep(delay)
+
+
+async def run(args, jobs, journal):
+    loop = asyncio.get_running_loop()
+    backends = [Backend(url, args.connections, args.timeout) for url in args.backend]
+    io_pool = ThreadPoolExecutor(max_workers=len(backends) * args.connections + args.writers)
+    writer_pool = ThreadPoolExecutor(max_workers=args.writers)
+    writer = OutputWriter(args.out, journal)
+    scheduler = Scheduler(loop, backends, args.lookahead)
+    defaults = dict(parse_setting(setting) for setting in args.set)
+    failed = 0
+    unknown = {}
+
+    def plan():
+        try:
+            for job in jobs:
+                if not scheduler.add(job):
+                    break
+        finally:
+            scheduler.close()
+
+    async def worker(backend):
+        nonlocal failed
+        while (job := await scheduler.take(backend)) is not None:
+            model = job.args.get('sd_model_hash')
+            checkpoint = backend.resolve(model)
+            if model is not None and checkpoint is None:
+                unknown[model] = unknown.get(model, 0) + 1
+                continue
+            try:
+                response = await call(backend, "POST", "/sdapi/v1/txt2img", job_payload(job, checkpoint, defaults),
+                                      io_pool, args.retries, args.backoff)
+                await loop.run_in_executor(writer_pool, writer.write, job, backend, checkpoint, response)
+            except (TransientError, RuntimeError, OSError, ValueError) as e:
+                failed += 1
+                print(f"Failed {job.source}: {e}")
+                continue
+            backend.jobs += 1
+            done = sum(b.jobs for b in backends)
+            print(f"[{done}/{scheduler.planned}] {backend.url} {job.source}")
+
+    async def connect(backend):
+        try:
+            backend.set_checkpoints(await call(backend, "GET", "/sdapi/v1/sd-models", None, io_pool, args.retries,
+                                               args.backoff))
+            return True
+        except (TransientError, RuntimeError, ValueError) as e:
+            print(f"Leaving out the backend, {e}")
+            return False
+
+    started = time.perf_counter()
+    try:
+        connected = await asyncio.gather(*(connect(backend) for backend in backends))
+        backends[:] = [backend for backend, ok in zip(backends, connected) if ok]
+        if not backends:
+            print("No backend to run the batch on.")
+            return 1
+        planner = loop.run_in_executor(None, plan)
+        await asyncio.gather(planner, *(worker(backend) for backend in backends for _ in range(args.connections)))
+    finally:
+        scheduler.stopped = True
+        writer_pool.shutdown()
+        writer.close()
+        for backend in backends:
+            backend.close()
+        io_pool.shutdown()
+
+    wall = time.perf_counter() - started
+    print(f"{'backend':<40}{'jobs':>8}{'switches':>10}{'retries':>9}")
+    for backend in backends:
+        print(f"{backend.url:<40}{backend.jobs:>8}{backend.switches:>10}{backend.retries:>9}")
+    print(f"{writer.images} images in {wall:.1f} s, {failed} failed jobs.")
+    for model, count in unknown.items():
+        print(f"Skipped {count} jobs using {model}, unknown to the backends.")
+    return 1 if failed or unknown else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("script", choices=["A", "B", "frominfo"], help="input format, as the script of the same name")
+    parser.add_argument("inputs", help="list of images or infotexts, - for stdin")
+    parser.add_argument("--backend", action="append", required=True, help="webui URL, repeat for several instances")
+    parser.add_argument("--out", default="outputs", help="output folder")
+    parser.add_argument("--connections", type=int, default=2, help="concurrent requests per backend")
+    parser.add_argument("--writers", type=int, default=4, help="threads writing the images")
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--backoff", type=float, default=2.0, help="seconds before the first retry, doubled after")
+    parser.add_argument("--timeout", type=float, default=600.0, help="seconds to wait for a request")
+    parser.add_argument("--lookahead", type=int, default=64)
+    parser.add_argument("--reader-threads", type=int, default=8)
+    parser.add_argument("--override", action="append", default=[], choices=[o[len("Override "):] for o in
+                                                                           sc.possible_overrides],
+                        help="use the --set value (or the webui default) instead of the one of the source")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="txt2img parameter sent with every job, e.g. steps=30")
+    parser.add_argument("--prepend", default="", help="text to prepend to the prompts")
+    parser.add_argument("--append", action="store_true", help="append the --prepend text instead")
+    parser.add_argument("--start", type=int, default=0, help="first entry")
+    parser.add_argument("--stop", type=int, default=0, help="stop before this entry (0 = last)")
+    parser.add_argument("--resume", action="store_true", help="skip the jobs completed by a previous run")
+    args = parser.parse_args(argv)
+
+    overrides = ["Override " + name for name in args.override]
+    options = sc.BatchOptions(reader_threads=args.reader_threads, lookahead=args.lookahead, entry_start=args.start,
+                              entry_stop=args.stop, resume=args.resume,
+                              source_file='' if args.inputs == "-" else args.inputs)
+    text = sys.stdin.read() if args.inputs == "-" else ""
+    job_parser = sc.JobParser(overrides, args.prepend, args.append, cast_value=lambda name, value: value)
+
+    key = sc.run_key("cli", sc.source_key(args.script, text, overrides, args.prepend, args.append, options),
+                     sorted(args.set))
+    journal = sc.Journal(key, args.resume)
+    try:
+        jobs = journal.track(sc.plan_jobs(args.script, text, job_parser, options))
+        return asyncio.run(run(args, jobs, journal))
+    finally:
+        journal.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""Drive the batch API (scripts/batchapi.py) with FastAPI's TestClient, against the stub webui in benchmarks/stubs.
+
+    python benchmarks/bench_api.py --batches 8 --entries 200 --models 6
+
+Submits several infotext batches at once, streams the results of the first one and polls the others until they are
+done, then does the same submitting each batch only once the previous one is done, which is what clicking Generate
+for each of them amounts to. Needs fastapi and httpx.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), "stubs"), os.path.dirname(os.path.dirname(__file__))]
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+import scripts.batchapi as api  # noqa: E402
+import scripts.script_common as sc  # noqa: E402
+from bench_run import make_infotexts  # noqa: E402
+from modules import processing  # noqa: E402
+from modules import sd_models  # noqa: E402
+from modules import shared  # noqa: E402
+
+
+def wait(client, batch_ids):
+    while True:
+        statuses = [client.get(f"{api.api_prefix}/batches/{batch_id}").json() for batch_id in batch_ids]
+        if all(status["state"] in ("done", "failed", "cancelled") for status in statuses):
+            return statuses
+        time.sleep(0.05)
+
+
+def run(batches, merged, lookahead):
+    app = FastAPI()
+    queue = api.mount_api(app, api.BatchQueue(lookahead))
+    shared.stats.update(jobs=0, images=0, switches=0, simulated_time=0.0)
+    started = time.perf_counter()
+    with TestClient(app) as client:
+        statuses = []
+        if merged:
+            batch_ids = [client.post(f"{api.api_prefix}/batches", json=batch).json()["id"] for batch in batches]
+            with client.stream("GET", f"{api.api_prefix}/batches/{batch_ids[0]}/stream") as response:
+                streamed = sum(1 for line in response.iter_lines() if line and json.loads(line))
+            statuses = wait(client, batch_ids)
+        else:
+            for batch in batches:
+                statuses += wait(client, [client.post(f"{api.api_prefix}/batches", json=batch).json()["id"]])
+            streamed = None
+    wall = time.perf_counter() - started
+    return statuses, streamed, queue, wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batches", type=int, default=6)
+    parser.add_argument("--entries", type=int, default=200, help="entries per batch")
+    parser.add_argument("--models", type=int, default=4)
+    parser.add_argument("--reload-latency", type=float, default=15.0, help="simulated seconds per checkpoint switch")
+    parser.add_argument("--seconds-per-megapixel-step", type=float, default=0.02)
+    parser.add_argument("--lookahead", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    processing.seconds_per_megapixel_step = args.seconds_per_megapixel_step
+    sd_models.reload_latency = args.reload_latency
+    rnd = random.Random(args.seed)
+    batches = [{"script": "frominfo", "prompt_txt": "\n\n".join(make_infotexts(args.entries, args.models, 1, rnd)),
+                "script_overrides": []} for _ in range(args.batches)]
+
+    with tempfile.TemporaryDirectory(prefix="batchscripts-bench-") as tmp:
+        sc.checkpoint_index_path = os.path.join(tmp, "checkpoint_index.sqlite3")
+        print(f"{'submission':<14}{'jobs':>8}{'images':>8}{'switches':>10}{'simulated':>12}{'wall':>9}  streamed")
+        for merged in (True, False):
+            statuses, streamed, queue, wall = run(batches, merged, args.lookahead)
+            stats = shared.stats
+            print(f"{'all at once' if merged else 'one by one':<14}{stats['jobs']:>8}"
+                  f"{sum(status['images'] for status in statuses):>8}{stats['switches']:>10}"
+                  f"{stats['simulated_time']:>11.0f}s{wall:>8.2f}s  {'' if streamed is None else streamed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Run batchscripts_cli.py against local mock webui backends (benchmarks/mock_webui.py), on a CPU-only box.
+
+    python benchmarks/bench_cli.py --backends 3 --entries 2000 --models 6 --fail-rate 0.05
+
+The infotexts are synthetic, as in bench_run.py. The mock backends only sleep --time-scale of the simulated time.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path[:0] = [os.path.dirname(__file__), os.path.dirname(os.path.dirname(__file__))]
+
+import batchscripts_cli  # noqa: E402
+import mock_webui  # noqa: E402
+import scripts.script_common as sc  # noqa: E402
+from bench_run import make_infotexts  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", type=int, default=2)
+    parser.add_argument("--connections", type=int, default=2)
+    parser.add_argument("--entries", type=int, default=1000)
+    parser.add_argument("--models", type=int, default=4)
+    parser.add_argument("--seeds-per-prompt", type=int, default=1)
+    parser.add_argument("--reload-latency", type=float, default=15.0)
+    parser.add_argument("--seconds-per-megapixel-step", type=float, default=0.02)
+    parser.add_argument("--time-scale", type=float, default=0.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    servers = [mock_webui.start(checkpoints=args.models, seconds_per_megapixel_step=args.seconds_per_megapixel_step,
+                                reload_latency=args.reload_latency, time_scale=args.time_scale,
+                                fail_rate=args.fail_rate, seed=args.seed + n) for n in range(args.backends)]
+    urls = [f"http://127.0.0.1:{server.server_port}" for server in servers]
+
+    with tempfile.TemporaryDirectory(prefix="batchscripts-bench-") as tmp:
+        sc.journal_dir = os.path.join(tmp, "journals")
+        source = os.path.join(tmp, "infotexts.txt")
+        with open(source, "w", encoding="utf8") as f:
+            f.write("\n\n".join(make_infotexts(args.entries, args.models, args.seeds_per_prompt,
+                                               random.Random(args.seed))))
+
+        argv = ["frominfo", source, "--out", os.path.join(tmp, "outputs"), "--connections", str(args.connections),
+                "--backoff", "0.01"]
+        for url in urls:
+            argv += ["--backend", url]
+        started = time.perf_counter()
+        status = batchscripts_cli.main(argv)
+        wall = time.perf_counter() - started
+
+        with open(os.path.join(tmp, "outputs", batchscripts_cli.manifest_filename), encoding="utf8") as f:
+            manifest = [json.loads(line) for line in f]
+
+    print()
+    print(f"{'backend':<28}{'requests':>10}{'failures':>10}{'switches':>10}{'simulated':>12}")
+    for url in urls:
+        with urllib.request.urlopen(url + "/mock/stats") as response:
+            stats = json.load(response)
+        print(f"{url:<28}{stats['requests']:>10}{stats['failures']:>10}{stats['switches']:>10}"
+              f"{stats['simulated_time']:>11.0f}s")
+    print(f"{'jobs in the manifest':<28}{len(manifest)}")
+    print(f"{'exit status':<28}{status}")
+    print(f"{'run wall time':<28}{wall:.2f} s")
+    for server in servers:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
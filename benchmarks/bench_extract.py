@@ -0,0 +1,124 @@
+"""Throughput of the metadata extractors on a synthetic corpus of JPEG, WebP and PNG files with webui style parameters.
+
+    python benchmarks/bench_extract.py --files 500 --image-kb 2048
+
+The baseline is the path the imagelist scripts took before: reading the whole file and decoding it with PIL, as
+modules.images.image_data does. Without PIL installed, the baseline only reads the whole file, which is a lower
+bound of its cost.
+"""
+import argparse
+import io
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), "stubs"), os.path.dirname(os.path.dirname(__file__))]
+
+import scripts.script_common as sc  # noqa: E402
+from bench_run import make_infotexts  # noqa: E402
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def make_exif(text):
+    # "Exif" payload as written by piexif: IFD0 with a pointer to the Exif IFD, which holds a UNICODE UserComment
+    comment = b'UNICODE\0' + text.encode('utf-16-be')
+    ifd0 = struct.pack('>H', 1) + struct.pack('>HHII', sc.EXIF_IFD_POINTER, 4, 1, 26) + struct.pack('>I', 0)
+    exif_ifd = struct.pack('>H', 1) + struct.pack('>HHII', sc.EXIF_USER_COMMENT, 7, len(comment), 44)
+    exif_ifd += struct.pack('>I', 0)
+    return sc.EXIF_HEADER + b'MM\0\x2a' + struct.pack('>I', 8) + ifd0 + exif_ifd + comment
+
+
+def write_jpeg(path, text, size):
+    exif = make_exif(text)
+    with open(path, "wb") as f:
+        f.write(b'\xff\xd8')
+        f.write(b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\0\x01\x01\0\0\x01\0\x01\0\0')
+        f.write(b'\xff\xe1' + struct.pack('>H', len(exif) + 2) + exif)
+        f.write(b'\xff\xda' + struct.pack('>H', 8) + b'\x01\x01\0\0\x3f\0')
+        f.write(os.urandom(size).replace(b'\xff', b'\0'))
+        f.write(b'\xff\xd9')
+
+
+def riff_chunk(chunk_type, data):
+    return chunk_type + struct.pack('<I', len(data)) + data + b'\0' * (len(data) & 1)
+
+
+def write_webp(path, text, size):
+    body = b'WEBP' + riff_chunk(b'VP8X', bytes([0x08, 0, 0, 0]) + b'\0' * 6) + riff_chunk(b'VP8 ', os.urandom(size))
+    body += riff_chunk(b'EXIF', make_exif(text))
+    with open(path, "wb") as f:
+        f.write(b'RIFF' + struct.pack('<I', len(body)) + body)
+
+
+def write_png(path, text, size):
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+    with open(path, "wb") as f:
+        f.write(sc.PNG_SIGNATURE + chunk(b'IHDR', struct.pack('>IIBBBBB', 512, 512, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'tEXt', b'parameters\0' + text.encode('latin-1')) + chunk(b'IDAT', os.urandom(size)))
+        f.write(chunk(b'IEND', b''))
+
+
+def baseline(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if Image is None:
+        return len(data)
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image.info.get('parameters') or image.getexif()
+
+
+def timed(function, paths):
+    started = time.perf_counter()
+    results = [function(path) for path in paths]
+    return time.perf_counter() - started, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=300, help="files per format")
+    parser.add_argument("--image-kb", type=int, default=1024, help="size of the pixel data of the synthetic files")
+    parser.add_argument("--sidecars", action="store_true", help="also time files with only a sidecar .txt")
+    args = parser.parse_args()
+
+    formats = {"jpeg": write_jpeg, "webp": write_webp, "png": write_png}
+    with tempfile.TemporaryDirectory(prefix="batchscripts-bench-") as tmp:
+        corpus = {}
+        texts = list(make_infotexts(args.files, 4, 1, random.Random(0)))
+        for name, write in formats.items():
+            corpus[name] = []
+            for n, text in enumerate(texts):
+                path = os.path.join(tmp, f"{n:06}.{name}")
+                write(path, text, args.image_kb * 1024)
+                corpus[name].append(path)
+        if args.sidecars:
+            corpus["sidecar"] = []
+            for n, text in enumerate(texts):
+                path = os.path.join(tmp, f"sidecar{n:06}.jpeg")
+                write_jpeg(path, "", args.image_kb * 1024)
+                with open(os.path.splitext(path)[0] + ".txt", "w", encoding="utf8") as f:
+                    f.write(text)
+                corpus["sidecar"].append(path)
+
+        print(f"baseline: {'full read and PIL decoding' if Image else 'full read only (PIL is not installed)'}")
+        print(f"{'format':<10}{'extractor files/s':>20}{'baseline files/s':>20}{'speedup':>10}  correct")
+        for name, paths in corpus.items():
+            elapsed, results = timed(sc.read_image_parameters, paths)
+            baseline_elapsed, _ = timed(baseline, paths)
+            correct = sum(result == text for result, text in zip(results, texts))
+            print(f"{name:<10}{len(paths) / elapsed:>20,.0f}{len(paths) / baseline_elapsed:>20,.0f}"
+                  f"{baseline_elapsed / elapsed:>9.1f}x  {correct}/{len(paths)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Planning throughput of the infotext -> Job engine of script_common.
+
+    python benchmarks/bench_parse.py --entries 100000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), "stubs"), os.path.dirname(os.path.dirname(__file__))]
+
+import scripts.script_common as sc  # noqa: E402
+
+samplers = ["Euler a", "DPM++ 2M Karras", "DPM++ SDE Karras", "DDIM"]
+models = ["0123456789", "abcdef0123", "fedcba9876"]
+
+
+def make_corpus(entries, seed=0):
+    rnd = random.Random(seed)
+    corpus = []
+    for n in range(entries):
+        params = [f"Steps: {rnd.randint(20, 50)}", f"Sampler: {rnd.choice(samplers)}",
+                  f"CFG scale: {rnd.choice([5, 7, 7.5, 10])}", f"Seed: {rnd.randint(0, 2 ** 32)}",
+                  f"Size: {rnd.choice([512, 768])}x{rnd.choice([512, 768])}", f"Model hash: {rnd.choice(models)}"]
+        if rnd.random() < 0.5:
+            params += ["Clip skip: 2", "ENSD: 31337"]
+        if rnd.random() < 0.3:
+            params += ["Denoising strength: 0.5", "Hires upscale: 2", "Hires upscaler: Latent"]
+        if rnd.random() < 0.2:
+            params += ['Lora hashes: "a: 0123, b: 4567"']
+        prompt = f"masterpiece, best quality, subject {n}, detailed background"
+        corpus.append(f"{prompt}\nNegative prompt: lowres, bad anatomy\n" + ", ".join(params))
+    return corpus
+
+
+def measure(name, func, corpus):
+    started = time.perf_counter()
+    for block in corpus:
+        func(block)
+    elapsed = time.perf_counter() - started
+    print(f"{name:<24} {len(corpus) / elapsed:>12,.0f} jobs/s  ({elapsed:.2f} s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=100000)
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.entries)
+    job_parser = sc.JobParser(["Override Seed"], "prepended text", cast_value=lambda name, value: value)
+
+    measure("parse_infotext", sc.parse_infotext, corpus)
+    measure("+ map_parameters", lambda block: sc.map_parameters(sc.parse_infotext(block)), corpus)
+    measure("JobParser.parse", job_parser.parse, corpus)
+
+
+if __name__ == "__main__":
+    main()
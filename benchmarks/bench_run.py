@@ -0,0 +1,173 @@
+"""Drive a batch script end to end against the stub webui in benchmarks/stubs, on a CPU-only box.
+
+    python benchmarks/bench_run.py --script frominfo --entries 5000 --models 6
+    python benchmarks/bench_run.py --script A --entries 2000 --png-kb 4096 --reload-latency 20
+
+process_images and reload_model_weights take a simulated time (steps x pixels, and a fixed switch cost), which is
+only slept for --time-scale of its value, so scheduling changes can be compared without waiting for them.
+"""
+import argparse
+import os
+import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path[:0] = [os.path.join(os.path.dirname(__file__), "stubs"), os.path.dirname(os.path.dirname(__file__))]
+
+import scripts.script_common as sc  # noqa: E402
+from modules import images  # noqa: E402
+from modules import processing  # noqa: E402
+from modules import sd_models  # noqa: E402
+from modules import shared  # noqa: E402
+
+samplers = ["Euler a", "DPM++ 2M Karras", "DDIM"]
+
+
+class FakeP:
+    """The attributes of StableDiffusionProcessingTxt2Img the scripts rely on."""
+
+    def __init__(self, outpath):
+        self.prompt = ""
+        self.negative_prompt = ""
+        self.seed = -1
+        self.n_iter = 1
+        self.batch_size = 1
+        self.steps = 20
+        self.cfg_scale = 7.0
+        self.sampler_name = "Euler a"
+        self.width = 512
+        self.height = 512
+        self.enable_hr = False
+        self.do_not_save_grid = False
+        self.do_not_save_samples = False
+        self.outpath_samples = outpath
+        self.override_settings = {}
+
+
+def make_infotexts(entries, models, seeds_per_prompt, rnd):
+    for n in range(entries):
+        prompt = n // seeds_per_prompt
+        params = [f"Steps: {rnd.choice([20, 30])}", f"Sampler: {samplers[prompt % len(samplers)]}", "CFG scale: 7",
+                  f"Seed: {1000 + n}", f"Size: {rnd.choice([512, 768])}x512",
+                  f"Model hash: {rnd.randrange(models):010x}"]
+        if prompt % 2:
+            params += ["Clip skip: 2"]
+        if prompt % 5 == 0:
+            params += ["Denoising strength: 0.5", "Hires upscale: 1.5", "Hires upscaler: Latent"]
+        yield f"subject {prompt}, detailed\nNegative prompt: lowres\n" + ", ".join(params)
+
+
+def png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+def write_png(path, text, size):
+    with open(path, "wb") as f:
+        f.write(sc.PNG_SIGNATURE)
+        f.write(png_chunk(b'IHDR', struct.pack('>IIBBBBB', 512, 512, 8, 2, 0, 0, 0)))
+        f.write(png_chunk(b'tEXt', b'parameters\0' + text.encode('latin-1')))
+        f.write(png_chunk(b'IDAT', os.urandom(size)))
+        f.write(png_chunk(b'IEND', b''))
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--script", choices=["A", "B", "frominfo"], default="frominfo")
+    parser.add_argument("--entries", type=int, default=2000)
+    parser.add_argument("--models", type=int, default=4)
+    parser.add_argument("--seeds-per-prompt", type=int, default=1)
+    parser.add_argument("--shuffle", action="store_true", help="scatter the entries of a prompt across the list")
+    parser.add_argument("--png-kb", type=int, default=256, help="size of the pixel data of the synthetic PNGs")
+    parser.add_argument("--reload-latency", type=float, default=15.0, help="simulated seconds per checkpoint switch")
+    parser.add_argument("--seconds-per-megapixel-step", type=float, default=0.02)
+    parser.add_argument("--save-latency", type=float, default=0.0, help="simulated seconds to save an image")
+    parser.add_argument("--writer-threads", type=int, default=0)
+    parser.add_argument("--time-scale", type=float, default=0.0, help="fraction of the simulated time to sleep")
+    parser.add_argument("--reader-threads", type=int, default=8)
+    parser.add_argument("--lookahead", type=int, default=64)
+    parser.add_argument("--max-batch-size", type=int, default=1)
+    parser.add_argument("--keep-order", action="store_true")
+    parser.add_argument("--shard", default="1/1", help="shard to run, as i/n")
+    parser.add_argument("--plan-only", action="store_true", help="run the dry run planner instead")
+    parser.add_argument("--trace", help="copy the timeline of the run to this file")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    processing.seconds_per_megapixel_step = args.seconds_per_megapixel_step
+    processing.time_scale = sd_models.time_scale = images.time_scale = args.time_scale
+    images.save_latency = args.save_latency
+    sd_models.reload_latency = args.reload_latency
+
+    with tempfile.TemporaryDirectory(prefix="batchscripts-bench-") as tmp:
+        sc.extension_dir = tmp
+        sc.cache_path = os.path.join(tmp, "parameters_cache.sqlite3")
+        sc.outputs_index_path = os.path.join(tmp, "outputs_index.sqlite3")
+        sc.journal_dir = os.path.join(tmp, "journals")
+        sc.timings_path = os.path.join(tmp, "timings.json")
+        sc.checkpoint_index_path = os.path.join(tmp, "checkpoint_index.sqlite3")
+
+        infotexts = list(make_infotexts(args.entries, args.models, args.seeds_per_prompt, rnd))
+        if args.shuffle:
+            rnd.shuffle(infotexts)
+        if args.script == "frominfo":
+            import scripts.batchfrominfo as script_module
+            prompt_txt = "\n\n".join(infotexts)
+        else:
+            os.makedirs(os.path.join(tmp, "images"))
+            paths = []
+            for n, text in enumerate(infotexts):
+                paths.append(os.path.join(tmp, "images", f"{n:06}.png"))
+                write_png(paths[-1], text, args.png_kb * 1024)
+            if args.script == "A":
+                import scripts.batchimagesA as script_module
+                prompt_txt = "\n".join(paths)
+            else:
+                import scripts.batchimagesB as script_module
+                prompt_txt = "\n".join(f'"{path}" 1' for path in paths)
+
+        options = sc.BatchOptions(reader_threads=args.reader_threads, lookahead=args.lookahead,
+                                  max_batch_size=args.max_batch_size, keep_order=args.keep_order,
+                                  trace=bool(args.trace), plan_only=args.plan_only, writer_threads=args.writer_threads,
+                                  shard_index=int(args.shard.split("/")[0]), shard_count=int(args.shard.split("/")[1]))
+        job_parser = sc.JobParser()
+
+        started = time.perf_counter()
+        if args.script == "frominfo":
+            planned = sum(1 for block in sc.source_entries(prompt_txt, options, blocks=True) if job_parser.parse(block))
+        else:
+            planned = sum(1 for _, _, error in sc.extract_parameters(paths, args.reader_threads, '') if error is None)
+        planning = time.perf_counter() - started
+
+        started = time.perf_counter()
+        script_module.Script().run(FakeP(os.path.join(tmp, "outputs")), "", False, prompt_txt, [], *options)
+        wall = time.perf_counter() - started
+        if args.trace:
+            shutil.copyfile(os.path.join(tmp, "outputs", sc.trace_filename), args.trace)
+
+    stats = shared.stats
+    print()
+    print(f"{'script':<28}{args.script}")
+    print(f"{'entries planned':<28}{planned}")
+    print(f"{'planning time':<28}{planning:.2f} s ({planned / planning:,.0f} entries/s)")
+    print(f"{'process_images calls':<28}{stats['jobs']}")
+    print(f"{'images':<28}{stats['images']}")
+    print(f"{'checkpoint switches':<28}{stats['switches']}")
+    print(f"{'simulated time':<28}{stats['simulated_time']:.0f} s")
+    print(f"{'images saved':<28}{stats['saved']} ({stats['simulated_save_time']:.0f} s simulated)")
+    print(f"{'run wall time':<28}{wall:.2f} s")
+    print(f"{'peak RSS':<28}{peak_rss_mb():.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""A stand-in for the webui HTTP API (sd-models and txt2img) to run batchscripts_cli.py against on a CPU-only box.
+
+    python benchmarks/mock_webui.py --port 7861 --checkpoints 4 --fail-rate 0.05
+
+Like webui, requests are served one at a time. A request takes a simulated time (steps x pixels, plus a fixed cost
+when it changes the loaded checkpoint) which is only slept for --time-scale of its value.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+
+def png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+def make_png(text):
+    # 1x1 RGB image with the infotext in a tEXt chunk, like webui's outputs
+    return (b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 2, 0, 0, 0)) +
+            png_chunk(b'tEXt', b'parameters\0' + text.encode('latin-1', errors='replace')) +
+            png_chunk(b'IDAT', zlib.compress(b'\0\0\0\0')) + png_chunk(b'IEND', b''))
+
+
+class MockWebui(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, checkpoints=4, seconds_per_megapixel_step=0.02, reload_latency=15.0, time_scale=0.0,
+                 fail_rate=0.0, seed=0):
+        super().__init__(address, Handler)
+        self.checkpoints = [{"title": f"model{n}.safetensors [{n:010x}]", "model_name": f"model{n}",
+                             "hash": f"{n:010x}", "sha256": f"{n:010x}" + "0" * 54, "filename": f"model{n}.safetensors"}
+                            for n in range(checkpoints)]
+        self.seconds_per_megapixel_step = seconds_per_megapixel_step
+        self.reload_latency = reload_latency
+        self.time_scale = time_scale
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.gpu = threading.Lock()
+        self.loaded = self.checkpoints[0]["title"] if self.checkpoints else None
+        self.stats = {"requests": 0, "failures": 0, "images": 0, "switches": 0, "simulated_time": 0.0}
+
+    def txt2img(self, payload):
+        with self.gpu:
+            self.stats["requests"] += 1
+            if self.random.random() < self.fail_rate:
+                self.stats["failures"] += 1
+                return 503, {"error": "simulated failure"}
+
+            simulated = 0.0
+            checkpoint = (payload.get("override_settings") or {}).get("sd_model_checkpoint")
+            if checkpoint is not None and checkpoint != self.loaded:
+                if checkpoint not in {c["title"] for c in self.checkpoints}:
+                    return 422, {"error": f"unknown checkpoint {checkpoint}"}
+                self.loaded = checkpoint
+                self.stats["switches"] += 1
+                simulated += self.reload_latency
+
+            count = payload.get("batch_size", 1) * payload.get("n_iter", 1)
+            megapixels = payload.get("width", 512) * payload.get("height", 512) / 1e6
+            simulated += megapixels * payload.get("steps", 20) * count * self.seconds_per_megapixel_step
+            self.stats["simulated_time"] += simulated
+            self.stats["images"] += count
+            time.sleep(simulated * self.time_scale)
+
+            seed = payload.get("seed", -1)
+            seeds = [seed + n if seed != -1 else self.random.randrange(2 ** 32) for n in range(count)]
+            infotexts = [f"{payload.get('prompt', '')}\nSteps: {payload.get('steps', 20)}, Seed: {s}, "
+                         f"Model: {self.loaded}" for s in seeds]
+            images = [base64.b64encode(make_png(text)).decode() for text in infotexts]
+            return 200, {"images": images, "parameters": payload,
+                         "info": json.dumps({"all_seeds": seeds, "infotexts": infotexts})}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, as the webui server
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/sdapi/v1/sd-models":
+            self.reply(200, self.server.checkpoints)
+        elif self.path == "/mock/stats":
+            self.reply(200, self.server.stats)
+        else:
+            self.reply(404, {"detail": "Not Found"})
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path == "/sdapi/v1/txt2img":
+            self.reply(*self.server.txt2img(payload))
+        else:
+            self.reply(404, {"detail": "Not Found"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(port=0, **kwargs):
+    # Serve in a background thread, returns the server (its URL is http://127.0.0.1:{server.server_port})
+    server = MockWebui(("127.0.0.1", port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=7861)
+    parser.add_argument("--checkpoints", type=int, default=4)
+    parser.add_argument("--seconds-per-megapixel-step", type=float, default=0.02)
+    parser.add_argument("--reload-latency", type=float, default=15.0, help="simulated seconds per checkpoint switch")
+    parser.add_argument("--time-scale", type=float, default=0.0, help="fraction of the simulated time to sleep")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of requests answered with HTTP 503")
+    args = parser.parse_args()
+
+    server = MockWebui(("127.0.0.1", args.port), args.checkpoints, args.seconds_per_megapixel_step,
+                       args.reload_latency, args.time_scale, args.fail_rate)
+    print(f"Mock webui API on http://127.0.0.1:{args.port} (pid {os.getpid()})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+# Minimal stand-in for gradio so script_common can be imported outside of webui. The UI is never built here.
+
+
+def update(**kwargs):
+    return kwargs
@@ -0,0 +1,4 @@
+"""Stand-in for webui's modules.call_queue: the lock generations are serialized on."""
+import threading
+
+queue_lock = threading.Lock()
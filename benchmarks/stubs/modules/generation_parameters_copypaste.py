@@ -0,0 +1,6 @@
+"""Stand-in for webui's modules.generation_parameters_copypaste."""
+import scripts.script_common as sc
+
+
+def parse_generation_parameters(x):
+    return sc.parse_infotext(x)
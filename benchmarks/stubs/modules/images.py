@@ -0,0 +1,51 @@
+"""Stand-in for webui's modules.images: image_data only reads PNG tEXt/iTXt "parameters" chunks, save_image takes a
+simulated time and writes nothing."""
+import os
+import struct
+import time
+import zlib
+
+from modules import shared
+
+save_latency = 0.0  # simulated seconds to encode and write an image
+time_scale = 0.0  # fraction of the simulated latency actually slept
+
+
+def image_data(data):
+    pos = 8
+    while pos + 8 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[pos:pos + 8])
+        chunk = data[pos + 8:pos + 8 + length]
+        pos += length + 12
+        keyword, _, text = chunk.partition(b'\0')
+        if keyword != b'parameters':
+            continue
+        if chunk_type == b'tEXt':
+            return text.decode('latin-1'), None
+        if chunk_type == b'iTXt':
+            text = text[2:].split(b'\0', 2)[2]
+            return (zlib.decompress(text) if chunk[len(keyword) + 1] else text).decode('utf-8'), None
+    return None, None
+
+
+class FilenameGenerator:
+    def __init__(self, p, seed, prompt, image):
+        self.values = {"seed": str(seed), "prompt_spaces": prompt[:64]}
+
+    def apply(self, pattern):
+        for key, value in self.values.items():
+            pattern = pattern.replace(f"[{key}]", value)
+        return pattern
+
+
+def get_next_sequence_number(path, basename):
+    return 0
+
+
+def save_image(image, path, basename, seed=None, prompt=None, extension='png', info=None, p=None,
+               forced_filename=None, **kwargs):
+    shared.stats["saved"] += 1
+    shared.stats["simulated_save_time"] += save_latency
+    time.sleep(save_latency * time_scale)
+    filename = os.path.join(path, f"{forced_filename or seed}.{extension}")
+    return filename, None
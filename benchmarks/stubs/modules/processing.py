@@ -0,0 +1,75 @@
+"""Stand-in for webui's modules.processing: process_images takes a simulated time proportional to the work, and saves
+the images inline when samples_save is on and do_not_save_samples is not set."""
+import time
+
+from modules import images as img
+from modules import shared
+
+seconds_per_megapixel_step = 0.02  # simulated generation cost
+time_scale = 0.0  # fraction of the simulated latencies actually slept
+
+
+class FakeImage:
+    def __init__(self, width, height):
+        self.size = (width, height)
+
+    def copy(self):
+        return FakeImage(*self.size)
+
+    def thumbnail(self, size):
+        self.size = (min(self.size[0], size[0]), min(self.size[1], size[1]))
+
+
+class StableDiffusionProcessingTxt2Img:
+    def __init__(self, sd_model=None, outpath_samples=None, outpath_grids=None, prompt="", negative_prompt="", seed=-1,
+                 n_iter=1, batch_size=1, steps=20, cfg_scale=7.0, sampler_name="Euler a", width=512, height=512,
+                 enable_hr=False, **kwargs):
+        self.sd_model = sd_model
+        self.outpath_samples = outpath_samples
+        self.outpath_grids = outpath_grids
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.seed = seed
+        self.n_iter = n_iter
+        self.batch_size = batch_size
+        self.steps = steps
+        self.cfg_scale = cfg_scale
+        self.sampler_name = sampler_name
+        self.width = width
+        self.height = height
+        self.enable_hr = enable_hr
+        self.do_not_save_grid = False
+        self.do_not_save_samples = False
+        self.override_settings = {}
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+
+class Processed:
+    def __init__(self, p, images_list, seed=-1, info="", all_prompts=None, infotexts=None, all_seeds=None):
+        self.images = images_list
+        self.seed = seed
+        self.info = info
+        self.all_prompts = all_prompts or []
+        self.infotexts = infotexts or []
+        self.all_seeds = all_seeds or [seed] * len(images_list)
+
+
+def process_images(p):
+    count = p.n_iter * p.batch_size
+    seeds = p.seed if isinstance(p.seed, list) else [p.seed + n for n in range(count)]
+    steps = p.steps + (getattr(p, 'hr_second_pass_steps', 0) or p.steps if getattr(p, 'enable_hr', False) else 0)
+    scale = (getattr(p, 'hr_scale', 1) or 1) ** 2 if getattr(p, 'enable_hr', False) else 1
+    latency = count * p.width * p.height / 1e6 * steps * scale * seconds_per_megapixel_step
+
+    shared.stats["jobs"] += 1
+    shared.stats["images"] += count
+    shared.stats["simulated_time"] += latency
+    time.sleep(latency * time_scale)
+
+    images = [FakeImage(p.width, p.height) for _ in range(count)]
+    infotexts = [f"{p.prompt}\nSteps: {p.steps}, Seed: {seed}" for seed in seeds]
+    if shared.opts.samples_save and not p.do_not_save_samples:
+        for image, seed, infotext in zip(images, seeds, infotexts):
+            image.already_saved_as = img.save_image(image, p.outpath_samples, "", seed, p.prompt, info=infotext)[0]
+    return Processed(p, images, seeds[0], "", all_prompts=[p.prompt] * count, infotexts=infotexts, all_seeds=seeds)
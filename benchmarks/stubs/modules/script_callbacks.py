@@ -0,0 +1,7 @@
+"""Stand-in for webui's modules.script_callbacks: callbacks are registered and never called."""
+
+callbacks_app_started = []
+
+
+def on_app_started(callback):
+    callbacks_app_started.append(callback)
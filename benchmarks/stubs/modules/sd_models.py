@@ -0,0 +1,31 @@
+"""Stand-in for webui's modules.sd_models. Any checkpoint name resolves, except the ones starting with "unknown"."""
+import time
+
+from modules import shared
+
+reload_latency = 0.0  # simulated seconds per checkpoint switch
+time_scale = 0.0  # fraction of the simulated latencies actually slept
+
+
+class CheckpointInfo:
+    def __init__(self, name):
+        self.title = name
+        self.name = name
+        self.model_name = name
+        self.filename = f"/nonexistent/{name}.safetensors"
+        self.hash = name[:8]
+        self.shorthash = name[:10]
+        self.sha256 = None
+
+
+def get_closet_checkpoint_match(search_string):
+    if search_string is None or search_string.startswith("unknown"):
+        return None
+    return CheckpointInfo(search_string)
+
+
+def reload_model_weights(sd_model=None, info=None):
+    shared.stats["switches"] += 1
+    shared.stats["simulated_time"] += reload_latency
+    shared.opts.sd_model_checkpoint = info.title
+    time.sleep(reload_latency * time_scale)
@@ -0,0 +1,44 @@
+"""Stand-in for webui's modules.shared: options, progress state and the counters the benchmarks report."""
+
+
+class Options:
+    sd_model_checkpoint = "base.safetensors [00000000]"
+    sd_checkpoint_cache = 0
+    samples_format = "png"
+    samples_save = True
+    samples_filename_pattern = ""
+    save_to_dirs = False
+    save_images_add_number = True
+    outdir_samples = ""
+    outdir_txt2img_samples = "outputs/txt2img-images"
+    outdir_grids = ""
+    outdir_txt2img_grids = "outputs/txt2img-grids"
+
+    def cast_value(self, key, value):
+        return value
+
+
+class State:
+    job = ""
+    job_no = 0
+    job_count = 0
+    interrupted = False
+    skipped = False
+
+    def begin(self, job=""):
+        self.job = job
+        self.interrupted = False
+
+    def end(self):
+        self.job = ""
+
+    def interrupt(self):
+        self.interrupted = True
+
+
+opts = Options()
+state = State()
+sd_model = None
+
+# filled by the fake processing and sd_models modules
+stats = {"images": 0, "jobs": 0, "switches": 0, "simulated_time": 0.0, "saved": 0, "simulated_save_time": 0.0}
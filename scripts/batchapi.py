@@ -0,0 +1,584 @@
+# The batch API: webui routes to queue batches without waiting for them, drained by a single worker, and the hot
+# folders feeding it. There is no Script here, webui loads this file to register the routes when its app starts.
+import heapq
+import itertools
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from modules import script_callbacks
+
+import scripts.script_common as sc
+
+api_prefix = "/batchscripts/v1"
+api_scripts = ("A", "B", "frominfo")
+api_batches_kept = 100  # finished batches still listed, the oldest are forgotten first
+# The batch options API batches honour, the ones about reading the source (see script_common.plan_jobs). The others
+# are refused unless left to their default.
+api_batch_options = ('reader_threads', 'source_file', 'entry_start', 'entry_stop', 'scan_extensions', 'scan_depth',
+                     'scan_after', 'scan_before')
+
+
+class ApiBatch:
+    """A batch submitted through the API: the fields of the script UI it was given, its counters and the events of its
+    completed jobs, which clients poll or stream. Jobs of higher priority batches run first; hold is how long a small
+    group of its jobs waits for more before the worker switches checkpoint for it."""
+
+    def __init__(self, batch_id, script, prompt_txt, script_overrides, prepend_prompt_text, append_prompt, options,
+                 txt2img, priority=0, hold=0.0, on_result=None):
+        self.id = batch_id
+        self.script = script
+        self.prompt_txt = prompt_txt
+        self.script_overrides = script_overrides
+        self.prepend_prompt_text = prepend_prompt_text
+        self.append_prompt = append_prompt
+        self.options = options
+        self.txt2img = txt2img
+        self.priority = priority
+        self.hold = hold
+        self.on_result = on_result  # called with the batch and the event of each of its completed jobs
+        self.submitted = time.time()
+        self.finished_at = None
+        self.planning = True
+        self.cancelled = False
+        self.error = None
+        self.planned = 0
+        self.done = 0
+        self.failed = 0
+        self.images = 0
+        self.events = []
+
+    def finished(self):
+        return (self.cancelled or self.error is not None or
+                (not self.planning and self.done + self.failed >= self.planned))
+
+    def state(self):
+        if self.cancelled:
+            return "cancelled"
+        if self.error is not None:
+            return "failed"
+        if self.finished():
+            return "done"
+        return "running" if self.done + self.failed else "queued"
+
+    def status(self):
+        return {"id": self.id, "script": self.script, "state": self.state(), "priority": self.priority,
+                "planning": self.planning,
+                "planned": self.planned, "done": self.done, "failed": self.failed, "images": self.images,
+                "events": len(self.events), "submitted": self.submitted, "finished": self.finished_at,
+                "error": self.error}
+
+
+class BatchQueue:
+    """The batches submitted through the API, drained by a single worker thread. Each batch is planned in its own
+    thread, and its jobs are queued by checkpoint, whichever batch they come from: the worker runs every queued job of
+    the loaded checkpoint before switching, then moves to the largest group once lookahead jobs are queued or no batch
+    is still planning. Jobs without a model hash run with whatever checkpoint is loaded.
+    A group of higher priority is switched to first, and a group of less than min_group jobs is only switched to once
+    the hold of its oldest job is over, so a trickle of jobs does not cost a switch each."""
+
+    def __init__(self, lookahead=64, min_group=16):
+        self.lookahead = lookahead
+        self.min_group = min_group
+        self.batches = {}
+        self.pending = {}  # checkpoint title (None: any) -> heap of (-priority, sequence, batch, job)
+        self.ready_at = {}  # checkpoint title -> time the oldest hold of its group is over
+        self.sequence = itertools.count()
+        self.count = 0
+        self.model = None
+        self.running = None
+        self.switches = 0
+        self.condition = threading.Condition()
+        self.worker = None
+
+    def submit(self, script, prompt_txt, script_overrides=None, prepend_prompt_text='', append_prompt=False,
+               options=None, txt2img=None, priority=0, hold=0.0, on_result=None):
+        # Queue a batch and return it right away, it is planned in the background
+        if script not in api_scripts:
+            raise ValueError(f"Unknown script {script}, expected one of {', '.join(api_scripts)}")
+        script_overrides = sc.default_overrides if script_overrides is None else script_overrides
+        unknown = [ovr for ovr in script_overrides if ovr not in sc.overrides_mapping]
+        if unknown:
+            raise ValueError(f"Unknown overrides: {', '.join(unknown)}")
+        options = options or {}
+        unknown = [name for name in options if name not in sc.BatchOptions._fields]
+        if unknown:
+            raise ValueError(f"Unknown batch options: {', '.join(unknown)}")
+        unsupported = [name for name, value in options.items()
+                       if name not in api_batch_options and value != sc.BatchOptions._field_defaults[name]]
+        if unsupported:
+            raise ValueError(f"Batch options not supported by the API: {', '.join(unsupported)}")
+        options = sc.BatchOptions(**options)
+        sc.scan_dates(options)
+
+        batch = ApiBatch(os.urandom(8).hex(), script, prompt_txt, list(script_overrides), prepend_prompt_text,
+                         append_prompt, options, dict(txt2img or {}), priority, hold, on_result)
+        with self.condition:
+            self.forget()
+            self.batches[batch.id] = batch
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.work, name="batchscripts-api-worker", daemon=True)
+                self.worker.start()
+        threading.Thread(target=self.plan, args=(batch,), name="batchscripts-api-planner", daemon=True).start()
+        return batch
+
+    def forget(self):
+        finished = sorted((batch for batch in self.batches.values() if batch.finished()),
+                          key=lambda batch: batch.finished_at or 0)
+        for batch in finished[:max(0, len(finished) - api_batches_kept)]:
+            del self.batches[batch.id]
+
+    def plan(self, batch):
+        sc.refresh_checkpoint_index()
+        try:
+            parser = sc.JobParser(batch.script_overrides, batch.prepend_prompt_text, batch.append_prompt)
+            jobs = sc.plan_jobs(batch.script, batch.prompt_txt, parser, batch.options)
+            for job in sc.skip_unknown_checkpoints(jobs, None):
+                if batch.cancelled:
+                    break
+                model = job.args.get('sd_model_hash')
+                model = None if model is None else sc.resolve_checkpoint(model).title
+                with self.condition:
+                    heapq.heappush(self.pending.setdefault(model, []),
+                                   (-batch.priority, next(self.sequence), batch, job))
+                    self.ready_at[model] = min(self.ready_at.get(model, math.inf), time.time() + batch.hold)
+                    self.count += 1
+                    batch.planned += 1
+                    self.condition.notify_all()
+        except Exception as e:
+            batch.error = f"{type(e).__name__}: {e}"
+        finally:
+            with self.condition:
+                batch.planning = False
+                if batch.finished():
+                    batch.finished_at = time.time()
+                self.condition.notify_all()
+        print(f"Batch {batch.id}: planned {batch.planned} jobs" + (f", {batch.error}" if batch.error else "."))
+
+    def next(self):
+        # The next (model, batch, job) to run, waiting for jobs to be queued
+        with self.condition:
+            while True:
+                now = time.time()
+                planning = any(batch.planning for batch in self.batches.values())
+                ready = []
+                wake = None
+                for model, jobs in self.pending.items():
+                    if model is None or model == self.model:
+                        ready.append(model)
+                    elif self.count >= self.lookahead or not planning:
+                        if len(jobs) >= self.min_group or self.ready_at[model] <= now:
+                            ready.append(model)
+                        else:
+                            wake = min(wake or math.inf, self.ready_at[model] - now)
+                if not ready:
+                    self.condition.wait(wake)
+                    continue
+
+                model = max(ready, key=lambda key: (-self.pending[key][0][0], key is None or key == self.model,
+                                                    len(self.pending[key])))
+                _, _, batch, job = heapq.heappop(self.pending[model])
+                if not self.pending[model]:
+                    del self.pending[model]
+                    self.ready_at.pop(model, None)
+                self.count -= 1
+                return model, batch, job
+
+    def work(self):
+        from modules import shared
+
+        self.model = shared.opts.sd_model_checkpoint
+        while True:
+            model, batch, job = self.next()
+            event = {"source": job.source}
+            started = time.perf_counter()
+            try:
+                proc = self.run_job(batch, job, model)
+                if proc is not None:
+                    event.update(checkpoint=self.model, files=[getattr(image, 'already_saved_as', None)
+                                                               for image in proc.images],
+                                 seeds=list(proc.all_seeds), infotexts=list(proc.infotexts))
+            except Exception as e:  # the job fails, not the queue
+                event.update(error=f"{type(e).__name__}: {e}")
+            event.update(duration=round(time.perf_counter() - started, 3))
+
+            with self.condition:
+                self.running = None
+                if not batch.cancelled:
+                    if "error" in event:
+                        batch.failed += 1
+                    else:
+                        batch.done += 1
+                        batch.images += len(event["files"])
+                    batch.events.append(event)
+                    if batch.finished():
+                        batch.finished_at = time.time()
+                self.condition.notify_all()
+            if batch.on_result is not None and not batch.cancelled:
+                batch.on_result(batch, event)
+
+    def run_job(self, batch, job, model):
+        # Generate a job with the txt2img parameters of its batch, holding webui's queue lock as its own API does.
+        # The batch only counts as running once the lock is held, so that cancelling it while it waits doesn't
+        # interrupt the generation holding the lock. Returns None when the batch was cancelled before generating.
+        from modules import shared
+        from modules.call_queue import queue_lock
+        from modules.processing import StableDiffusionProcessingTxt2Img
+        from modules.processing import process_images
+
+        with queue_lock:
+            shared.state.begin(job="batchscripts")
+            try:
+                with self.condition:
+                    if batch.cancelled:
+                        return None
+                    self.running = batch
+                if model is not None and model != shared.opts.sd_model_checkpoint:
+                    sc.apply_checkpoint(model)
+                    self.switches += 1
+                self.model = shared.opts.sd_model_checkpoint
+
+                p = StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **batch.txt2img)
+                p.outpath_samples = shared.opts.outdir_samples or shared.opts.outdir_txt2img_samples
+                p.outpath_grids = shared.opts.outdir_grids or shared.opts.outdir_txt2img_grids
+                p.do_not_save_grid = True
+                for k, v in job.args.items():
+                    setattr(p, k, v)
+                p.override_settings = job.override_settings
+                p.override_settings_restore_afterwards = True
+                if batch.cancelled:
+                    return None
+                return process_images(p)
+            finally:
+                shared.state.end()
+
+    def cancel(self, batch):
+        # Drop the queued jobs of the batch, and interrupt its job if it is the one running
+        from modules import shared
+
+        with self.condition:
+            if batch.finished():
+                return
+            batch.cancelled = True
+            batch.finished_at = time.time()
+            for model in list(self.pending):
+                kept = [item for item in self.pending[model] if item[2] is not batch]
+                self.count -= len(self.pending[model]) - len(kept)
+                if kept:
+                    heapq.heapify(kept)
+                    self.pending[model] = kept
+                else:
+                    del self.pending[model]
+                    self.ready_at.pop(model, None)
+            if self.running is batch:
+                shared.state.interrupt()
+            self.condition.notify_all()
+
+    def stream(self, batch, after=0, timeout=None):
+        # Events of the batch from index after, as they come, until it is finished
+        position = after
+        while True:
+            with self.condition:
+                if position >= len(batch.events) and not batch.finished():
+                    self.condition.wait(timeout)
+                events = batch.events[position:]
+                finished = batch.finished()
+            yield from events
+            position += len(events)
+            if finished and position >= len(batch.events):
+                return
+
+    def queued(self):
+        with self.condition:
+            return {"queued": self.count, "groups": {str(model): len(jobs) for model, jobs in self.pending.items()},
+                    "running": self.running.id if self.running is not None else None, "checkpoint": self.model,
+                    "switches": self.switches}
+
+
+hot_folders_path = os.path.join(sc.extension_dir, "hot_folders.sqlite3")
+hot_folder_interval = 5.0  # seconds between scans of the watched folders
+hot_folder_debounce = 10.0  # the new files of a folder are submitted once none of them changed for this long
+hot_folder_hold = 120.0  # seconds a small checkpoint group of a folder waits for more files before a switch
+
+
+class HotFolders:
+    """Folders watched for new images, which are re-rendered as imagelist A batches. Each scan stats the files of the
+    folders and queues the new or modified ones in a SQLite table, so the queue survives restarts and a file is only
+    queued again when it changes. Once no queued file of a folder has changed for the debounce delay, they are all
+    submitted to the BatchQueue as one batch with the folder's priority, settings and hold, and their state is updated
+    as their jobs complete. Folders are scanned by polling, which also works on network shares."""
+
+    def __init__(self, batches, path=None, interval=hot_folder_interval, debounce=hot_folder_debounce):
+        self.batches = batches
+        self.interval = interval
+        self.debounce = debounce
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.thread = None
+        self.db = sqlite3.connect(path or hot_folders_path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, priority INTEGER, "
+                        "settings TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, folder TEXT, size INTEGER, "
+                        "mtime REAL, changed REAL, state TEXT, batch TEXT, error TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_folder ON files (folder, state)")
+        # the batches of a previous session are gone, their files are queued again
+        self.db.execute("UPDATE files SET state = 'queued', batch = NULL WHERE state = 'submitted'")
+        self.db.commit()
+        self.folders = {folder: (priority, json.loads(settings)) for folder, priority, settings in
+                        self.db.execute("SELECT folder, priority, settings FROM folders")}
+        self.known = {}  # folder -> {path: (size, mtime)}, as in the table
+        if self.folders:
+            self.start()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="batchscripts-hot-folders", daemon=True)
+            self.thread.start()
+
+    def watch(self, folder, priority=0, script_overrides=None, prepend_prompt_text='', append_prompt=False,
+              txt2img=None, scan_extensions=sc.BatchOptions._field_defaults['scan_extensions'], scan_depth=0,
+              hold=hot_folder_hold):
+        folder = os.path.abspath(folder)
+        if not os.path.isdir(folder):
+            raise ValueError(f"Not a folder: {folder}")
+        unknown = [ovr for ovr in script_overrides or () if ovr not in sc.overrides_mapping]
+        if unknown:
+            raise ValueError(f"Unknown overrides: {', '.join(unknown)}")
+        settings = {"script_overrides": sc.default_overrides if script_overrides is None else list(script_overrides),
+                    "prepend_prompt_text": prepend_prompt_text, "append_prompt": append_prompt,
+                    "txt2img": dict(txt2img or {}), "scan_extensions": scan_extensions, "scan_depth": int(scan_depth),
+                    "hold": hold}
+        with self.lock:
+            self.folders[folder] = (priority, settings)
+            self.db.execute("INSERT OR REPLACE INTO folders VALUES (?, ?, ?)", (folder, priority, json.dumps(settings)))
+            self.db.commit()
+        self.start()
+        return folder
+
+    def unwatch(self, folder):
+        # Stop watching folder and forget its queued files, the ones already submitted still run
+        folder = os.path.abspath(folder)
+        with self.lock:
+            if self.folders.pop(folder, None) is None:
+                return False
+            self.known.pop(folder, None)
+            self.db.execute("DELETE FROM folders WHERE folder = ?", (folder,))
+            self.db.execute("DELETE FROM files WHERE folder = ? AND state = 'queued'", (folder,))
+            self.db.commit()
+        return True
+
+    def run(self):
+        while not self.stop.is_set():
+            # a snapshot, folders can be unwatched from the API meanwhile
+            with self.lock:
+                folders = list(self.folders.items())
+            for folder, (priority, settings) in folders:
+                try:
+                    self.scan(folder, settings)
+                    self.submit(folder, priority, settings)
+                except (OSError, sqlite3.Error, ValueError) as e:
+                    print(f"Hot folder {folder}: {e}")
+            self.reconcile()
+            self.stop.wait(self.interval)
+
+    def scan(self, folder, settings):
+        # Queue the new and modified files of folder. A file still being copied keeps changing, which delays the
+        # submission of the folder.
+        extensions = tuple(x.strip().lower() for x in settings["scan_extensions"].split(',') if x.strip())
+        with self.lock:
+            if folder not in self.folders:
+                return
+            known = self.known.get(folder)
+            if known is None:
+                known = self.known[folder] = {path: (size, mtime) for path, size, mtime in self.db.execute(
+                    "SELECT path, size, mtime FROM files WHERE folder = ?", (folder,))}
+
+        now = time.time()
+        changed = []
+        for path in sc.scan_files(folder, extensions, settings["scan_depth"]):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            signature = (st.st_size, st.st_mtime)
+            if known.get(path) != signature:
+                known[path] = signature
+                changed.append((path, folder, st.st_size, st.st_mtime, now))
+
+        if changed:
+            with self.lock:
+                if folder not in self.folders:
+                    return
+                self.db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, 'queued', NULL, NULL) ON CONFLICT (path) "
+                                    "DO UPDATE SET size = excluded.size, mtime = excluded.mtime, "
+                                    "changed = excluded.changed, state = 'queued', batch = NULL, error = NULL",
+                                    changed)
+                self.db.commit()
+
+    def submit(self, folder, priority, settings):
+        # Submit the queued files of folder as one batch, once none of them changed for the debounce delay
+        with self.lock:
+            if folder not in self.folders:
+                return
+            last_change, = self.db.execute("SELECT MAX(changed) FROM files WHERE folder = ? AND state = 'queued'",
+                                           (folder,)).fetchone()
+            if last_change is None or time.time() - last_change < self.debounce:
+                return
+            paths = [path for path, in self.db.execute(
+                "SELECT path FROM files WHERE folder = ? AND state = 'queued' ORDER BY path", (folder,))]
+
+        batch = self.batches.submit("A", "\n".join(paths), settings["script_overrides"],
+                                    settings["prepend_prompt_text"], settings["append_prompt"],
+                                    txt2img=settings["txt2img"], priority=priority, hold=settings["hold"],
+                                    on_result=self.record)
+        with self.lock:
+            self.db.executemany("UPDATE files SET state = 'submitted', batch = ? WHERE path = ? AND state = 'queued'",
+                                [(batch.id, path) for path in paths])
+            self.db.commit()
+        print(f"Hot folder {folder}: submitted {len(paths)} files as batch {batch.id}.")
+
+    def record(self, batch, event):
+        state = "failed" if "error" in event else "done"
+        with self.lock:
+            self.db.execute("UPDATE files SET state = ?, error = ? WHERE path = ? AND batch = ?",
+                            (state, event.get("error"), event["source"], batch.id))
+            self.db.commit()
+
+    def reconcile(self):
+        # Files of finished batches left without a result had no parameters to read, or their batch was cancelled
+        with self.lock:
+            batch_ids = [batch_id for batch_id, in self.db.execute(
+                "SELECT DISTINCT batch FROM files WHERE state = 'submitted'")]
+            finished = [batch_id for batch_id in batch_ids if batch_id not in self.batches.batches or
+                        self.batches.batches[batch_id].finished()]
+            if finished:
+                self.db.executemany("UPDATE files SET state = 'skipped' WHERE batch = ? AND state = 'submitted'",
+                                    [(batch_id,) for batch_id in finished])
+                self.db.commit()
+
+    def status(self):
+        with self.lock:
+            counts = defaultdict(dict)
+            for folder, state, count in self.db.execute(
+                    "SELECT folder, state, COUNT(*) FROM files GROUP BY folder, state"):
+                counts[folder][state] = count
+            return [{"folder": folder, "priority": priority, **settings, "files": counts.get(folder, {})}
+                    for folder, (priority, settings) in self.folders.items()]
+
+    def close(self):
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.db.close()
+
+
+batch_queue = None
+hot_folders = None
+
+
+def mount_api(app, batches=None, folders=None):
+    # Routes of the batch API, registered on webui's FastAPI app when it starts. Batches take the same fields as the
+    # script UI; submitting returns the batch id right away, the batch is then polled, streamed as JSON lines or
+    # cancelled by id. The hot folder routes are there when there are HotFolders, which is always the case with the
+    # default BatchQueue.
+    global batch_queue, hot_folders
+    from fastapi import HTTPException
+    from fastapi.responses import StreamingResponse
+    from pydantic import BaseModel
+    from pydantic import Field
+
+    if batches is None:
+        batch_queue = batch_queue or BatchQueue()
+        hot_folders = hot_folders or HotFolders(batch_queue)
+        batches = batch_queue
+        folders = folders or hot_folders
+
+    class BatchRequest(BaseModel):
+        script: str = "frominfo"
+        prompt_txt: str = ""
+        script_overrides: list[str] = Field(default_factory=lambda: list(sc.default_overrides))
+        prepend_prompt_text: str = ""
+        append_prompt: bool = False
+        batch_options: dict = Field(default_factory=dict)
+        txt2img: dict = Field(default_factory=dict)
+        priority: int = 0
+
+    class WatchRequest(BaseModel):
+        folder: str
+        priority: int = 0
+        script_overrides: list[str] = Field(default_factory=lambda: list(sc.default_overrides))
+        prepend_prompt_text: str = ""
+        append_prompt: bool = False
+        txt2img: dict = Field(default_factory=dict)
+        scan_extensions: str = sc.BatchOptions._field_defaults['scan_extensions']
+        scan_depth: int = 0
+        hold: float = hot_folder_hold
+
+    def get(batch_id):
+        batch = batches.batches.get(batch_id)
+        if batch is None:
+            raise HTTPException(status_code=404, detail=f"Unknown batch {batch_id}")
+        return batch
+
+    @app.post(api_prefix + "/batches", status_code=202)
+    def submit(request: BatchRequest):
+        try:
+            batch = batches.submit(request.script, request.prompt_txt, request.script_overrides,
+                                   request.prepend_prompt_text, request.append_prompt, request.batch_options,
+                                   request.txt2img, request.priority)
+        except (ValueError, TypeError) as e:
+            raise HTTPException(status_code=422, detail=str(e)) from e
+        return batch.status()
+
+    @app.get(api_prefix + "/batches")
+    def list_batches():
+        return {"batches": [batch.status() for batch in list(batches.batches.values())], **batches.queued()}
+
+    @app.get(api_prefix + "/batches/{batch_id}")
+    def poll(batch_id: str, after: int = 0):
+        batch = get(batch_id)
+        return {**batch.status(), "results": batch.events[after:]}
+
+    @app.get(api_prefix + "/batches/{batch_id}/stream")
+    def stream(batch_id: str, after: int = 0):
+        batch = get(batch_id)
+        lines = (json.dumps(event, default=str) + "\n" for event in batches.stream(batch, after, timeout=1.0))
+        return StreamingResponse(lines, media_type="application/x-ndjson")
+
+    @app.post(api_prefix + "/batches/{batch_id}/cancel")
+    def cancel(batch_id: str):
+        batch = get(batch_id)
+        batches.cancel(batch)
+        return batch.status()
+
+    if folders is not None:
+        @app.get(api_prefix + "/watch")
+        def watched():
+            return {"folders": folders.status()}
+
+        @app.post(api_prefix + "/watch")
+        def watch(request: WatchRequest):
+            try:
+                folders.watch(**request.dict())
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=str(e)) from e
+            return {"folders": folders.status()}
+
+        @app.post(api_prefix + "/watch/remove")
+        def unwatch(request: WatchRequest):
+            if not folders.unwatch(request.folder):
+                raise HTTPException(status_code=404, detail=f"Not watching {request.folder}")
+            return {"folders": folders.status()}
+
+    return batches
+
+
+def on_app_started(demo, app):
+    mount_api(app)
+
+
+script_callbacks.on_app_started(on_app_started)
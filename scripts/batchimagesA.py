@@ -1,13 +1,6 @@
-import copy
-import os
-
 import gradio as gr
 import modules.scripts as scripts
 import scripts.script_common as sc
-from modules import shared
-from modules.processing import Processed
-from modules.processing import process_images
-from modules.shared import state
 
 
 
@@ -42,123 +35,14 @@ class Script(scripts.Script):
     # to be used in processing. The return value should be a Processed object, which is
     # what is returned by the process_images method.
 
-    def run(self, p, prepend_prompt_text: str, append_prompt: bool, prompt_txt: str, script_overrides: list[str]):
-
-        import modules.images as img
-        import modules.generation_parameters_copypaste as gpc
-        from modules import sd_models as sdm
-
-        def update_dict_keys(obj, mapping_dict):
-            if isinstance(obj, dict):
-                return {mapping_dict[k]: update_dict_keys(v, mapping_dict) for k, v in obj.items() if mapping_dict.get(k)}
-            else:
-                return obj
+    def run(self, p, prepend_prompt_text: str, append_prompt: bool, prompt_txt: str, script_overrides: list[str],
+            *batch_options):
 
-        def apply_checkpoint(x):
-            info = sdm.get_closet_checkpoint_match(x)
-            if info is None:
-                raise RuntimeError(f"Unknown checkpoint: {x}")
-            sdm.reload_model_weights(shared.sd_model, info)
-
-        fallback_checkpoint = shared.opts.sd_model_checkpoint
-        checkpoint_switched = False
-
-        lines = [x.strip() for x in prompt_txt.splitlines()]
-        lines = [x for x in lines if len(x) > 0]
+        options = sc.BatchOptions(*batch_options)
 
         p.do_not_save_grid = True
 
-        job_count = 0
-        jobs = []
-        overrides = []
-
-        for line in lines:
-
-            if os.path.isfile(line):
-                formated_args = {}
-                f = open(line, "rb")
-                data = f.read()
-                f.close()
-                if data:
-                    info = img.image_data(data)
-                    res = gpc.parse_generation_parameters(info[0])
-                    args = update_dict_keys(res, sc.arg_mapping)
-
-                    for ovr in sc.possible_overrides:
-                        if ovr in script_overrides:
-                            args.pop(sc.overrides_mapping.get(ovr, None))
-
-                    for arg, val in args.items():
-                        func = sc.prompt_tags.get(arg, None)
-                        assert func, f'unknown file setting: {arg}'
-                        formated_args[arg] = func(val)
-
-                    if (formated_args.get('hr_scale', 0) > 0) or (formated_args.get('hr_resize_x', 0) > 0) or (
-                            formated_args.get('hr_resize_y', 0) > 0):
-                        formated_args['enable_hr'] = True
-                    else:
-                        formated_args['enable_hr'] = False
-
-                    if formated_args.get('face_restoration_model', False):
-                        formated_args['restore_faces'] = True
-
-                        seed_resize = formated_args.get('seed_resize', None)
-                        if seed_resize:
-                            formated_args['seed_resize_from_w'] = seed_resize[0]
-                            formated_args['seed_resize_from_h'] = seed_resize[1]
-                            formated_args.pop('restore_faces', None)
-
-                    override_settings = {}
-
-                    for setting_name in sc.override_list:
-                        value = formated_args.pop(setting_name, None)
-                        if value is None:
-                            continue
-                        override_settings[setting_name] = shared.opts.cast_value(setting_name, value)
-
-                    job_count += formated_args.get("n_iter", p.n_iter)
-                    jobs.append(formated_args)
-                    overrides.append(override_settings)
-
-        print(f"Read {len(lines)} lines, will process {len(jobs)} jobs generating {job_count} images.")
-
-        images = []
-        all_prompts = []
-        infotexts = []
-
-        def process_runlist(jobs, images, all_prompts, infotexts):
-            for n, args in enumerate(jobs):
-                state.job = f"{state.job_no + 1} out of {state.job_count}"
-
-                copy_p = copy.copy(p)
-                for k, v in args.items():
-                    setattr(copy_p, k, v)
-
-                copy_p.override_settings = overrides[n]
-                copy_p.override_settings_restore_afterwards = True
-                copy_p.extra_generation_params = {}
-
-                proc = process_images(copy_p)
-                images += proc.images
-
-                all_prompts += proc.all_prompts
-                infotexts += proc.infotexts
-
-        models_to_use = {j.get('sd_model_hash') for j in jobs}
-        runs_list = {}
-        for model in models_to_use:
-            runs_list[model] = [j for j in jobs if j.get('sd_model_hash') == model]
-        if None in runs_list.keys():
-            process_runlist(runs_list[None], images, all_prompts, infotexts)
-            runs_list.pop(None)
-        if fallback_checkpoint in runs_list.keys():
-            process_runlist(runs_list[fallback_checkpoint], images, all_prompts, infotexts)
-            runs_list.pop(fallback_checkpoint)
-        for model in runs_list.keys():
-            apply_checkpoint(model)
-            checkpoint_switched = True
-            process_runlist(runs_list[model], images, all_prompts, infotexts)
-        if checkpoint_switched:
-            apply_checkpoint(fallback_checkpoint)
-
-        return Processed(p, images, p.seed, "", all_prompts=all_prompts, infotexts=infotexts)
+        parser = sc.JobParser(script_overrides, prepend_prompt_text, append_prompt)
+
+        key = sc.source_key(self.title(), prompt_txt, script_overrides, prepend_prompt_text, append_prompt, options)
+        return sc.process_jobs(p, sc.plan_jobs("A", prompt_txt, parser, options, p), options, key)
@@ -1,5 +1,37 @@
-import gradio as gr
-import modules.scripts as scripts
+import atexit
+import bisect
+import copy
+import datetime
+import fnmatch
+import functools
+import glob
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import queue
+import re
+import shutil
+import sqlite3
+import stat
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import defaultdict
+from collections import deque
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import modules.scripts as scripts
+
+# gradio and the webui modules are imported where they are used, so the parsing and planning can run headless
+# (see batchscripts_cli.py)
 
 arg_mapping = {
     'Prompt': 'prompt',
@@ -41,7 +73,9 @@ arg_mapping = {
     'Variation seed strength': 'subseed_strength',
     'Face restoration': 'face_restoration_model',
     'Mask blur': 'mask_blur',
-    'Seed resize from': 'seed_resize'
+    'Seed resize from': 'seed_resize',
+    'Seed resize from-1': 'seed_resize_from_w',
+    'Seed resize from-2': 'seed_resize_from_h'
 }
 
 override_list = [
@@ -68,7 +102,7 @@ def process_float_tag(tag):
 
 
 def process_boolean_tag(tag):
-    return True if (tag == "true") else False
+    return True if (str(tag).lower() == "true") else False
 
 
 def process_seedresize_tag(tag):
@@ -116,7 +150,10 @@ prompt_tags = {
     "denoising_strength": process_float_tag,
     "face_restoration_model": process_string_tag,
     "mask_blur": process_int_tag,
-    "seed_resize": process_seedresize_tag
+    "seed_resize": process_seedresize_tag,
+    "inpainting_mask_weight": process_float_tag,
+    "initial_noise_multiplier": process_float_tag,
+    "always_discard_next_to_last_sigma": process_boolean_tag
 }
 
 overrides_mapping = {
@@ -131,30 +168,1994 @@ overrides_mapping = {
 possible_overrides = list(overrides_mapping.keys())
 default_overrides = ["Override Model"]
 
+# Values of the "Batch options" accordion, passed to run() after the script overrides
+BatchOptions = namedtuple('BatchOptions', ['reader_threads', 'lookahead', 'gallery_limit', 'max_batch_size',
+                                           'prefetch_budget', 'keep_order', 'resume', 'dedup', 'source_file',
+                                           'entry_start', 'entry_stop', 'scan_extensions', 'scan_depth',
+                                           'scan_after', 'scan_before', 'trace', 'plan_only', 'shard_index',
+                                           'shard_count', 'writer_threads'],
+                          defaults=[8, 64, 0, 1, 0, False, False, False, '', 0, 0, '.png, .jpg, .jpeg, .webp', 0,
+                                    '', '', False, False, 1, 1, 0])
+
+thumbnail_size = (256, 256)
+infotexts_filename = "batchscripts_infotexts.jsonl"
+trace_filename = "batchscripts_trace.json"
+
+
+class Tracer:
+    """Times the stages of a batch. Span durations are summed per category for the end of run summary and, when a
+    path is given, written as Chrome trace events (chrome://tracing, Perfetto) as they complete."""
+
+    categories = {'read': 'metadata read', 'parse': 'parse', 'switch': 'checkpoint switch',
+                  'generate': 'process_images', 'results': 'result handling', 'save': 'image writing'}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.file = None
+        self.totals = defaultdict(float)
+        self.origin = time.perf_counter()
+        self.first_event = True
+
+    def start(self, path=None):
+        self.close()
+        self.totals.clear()
+        self.origin = time.perf_counter()
+        self.first_event = True
+        if path:
+            self.file = open(path, "w", encoding="utf8")
+            self.file.write("[\n")
+
+    @contextmanager
+    def span(self, category, name=None, **args):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started
+            with self.lock:
+                self.totals[category] += duration
+                if self.file is not None:
+                    event = {"name": name or category, "cat": category, "ph": "X", "pid": os.getpid(),
+                             "tid": threading.get_ident(), "ts": round((started - self.origin) * 1e6),
+                             "dur": round(duration * 1e6), "args": args}
+                    self.file.write(("" if self.first_event else ",\n") + json.dumps(event, default=str))
+                    self.first_event = False
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.write("\n]\n")
+                self.file.close()
+                self.file = None
+
+    def summary(self, wall):
+        rows = [f"{'stage':<20}{'seconds':>10}{'% of run':>10}"]
+        for category, label in self.categories.items():
+            seconds = self.totals[category]
+            rows.append(f"{label:<20}{seconds:>10.1f}{100 * seconds / max(wall, 1e-9):>9.0f}%")
+        rows.append(f"{'total run':<20}{wall:>10.1f}")
+        return "\n".join(rows) + ("\n(metadata read, parse and image writing run in background threads, overlapping "
+                                  "generation)")
+
+
+tracer = Tracer()
+
+
+def job_cost(args, p):
+    # Work of a job in megapixel-steps, the unit of the ETA and of the runtime estimates
+    width = args.get('width', p.width)
+    height = args.get('height', p.height)
+    steps = args.get('steps', p.steps)
+    cost = width * height / 1e6 * steps
+    if args.get('enable_hr'):
+        hr_width = args.get('hr_resize_x') or width * args.get('hr_scale', 2)
+        hr_height = args.get('hr_resize_y') or height * args.get('hr_scale', 2)
+        cost += hr_width * hr_height / 1e6 * (args.get('hr_second_pass_steps') or steps)
+    return cost * args.get('n_iter', p.n_iter) * args.get('batch_size', p.batch_size)
+
+
+class Progress:
+    """Keeps webui's progress (state.job_count) right while the jobs are still being planned, and shows an ETA
+    based on the seconds per megapixel-step measured during the batch."""
+
+    def __init__(self, p, state):
+        self.p = p
+        self.state = state
+        self.planned_iterations = 0
+        self.planned_cost = 0.0
+        self.done_cost = 0.0
+        self.generation_time = 0.0
+        state.job_count = 0
+
+    def track(self, jobs):
+        for job in jobs:
+            self.planned_iterations += job.args.get('n_iter', self.p.n_iter)
+            self.planned_cost += job_cost(job.args, self.p)
+            self.state.job_count = self.planned_iterations
+            yield job
+
+    def done(self, job, duration):
+        # a packed job runs the iterations of all its entries at once
+        self.planned_iterations -= len(job.ids) - 1 if len(job.ids) > 1 else 0
+        self.state.job_count = self.planned_iterations
+        self.done_cost += job_cost(job.args, self.p)
+        self.generation_time += duration
+        if self.done_cost > 0:
+            rate = self.generation_time / self.done_cost
+            eta = max(0.0, self.planned_cost - self.done_cost) * rate
+            self.state.textinfo = (f"{rate:.3f} s per megapixel-step, about {datetime.timedelta(seconds=round(eta))} "
+                                   f"left for the jobs planned so far")
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+png_text_chunks = (b'tEXt', b'iTXt', b'zTXt')
+
+
+def read_png_parameters(path):
+    # Walk the PNG chunk stream and return the "parameters" text without reading the pixel data.
+    # Returns None when the file is not a PNG or no parameters chunk is found before the first IDAT.
+    with open(path, "rb") as f:
+        if f.read(8) != PNG_SIGNATURE:
+            return None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            length, chunk_type = struct.unpack('>I4s', header)
+            if chunk_type in (b'IDAT', b'IEND'):
+                return None
+            if chunk_type not in png_text_chunks:
+                f.seek(length + 4, 1)  # skip data and crc
+                continue
+            data = f.read(length)
+            f.seek(4, 1)
+            keyword, _, rest = data.partition(b'\0')
+            if keyword != b'parameters':
+                continue
+            if chunk_type == b'tEXt':
+                return rest.decode('latin-1')
+            if chunk_type == b'zTXt':
+                return zlib.decompress(rest[1:]).decode('latin-1')
+            # iTXt: compression flag, compression method, language tag, translated keyword, text
+            compressed, rest = rest[0], rest[2:]
+            rest = rest.split(b'\0', 2)[2]
+            if compressed:
+                rest = zlib.decompress(rest)
+            return rest.decode('utf-8', errors='ignore')
+
+
+EXIF_HEADER = b'Exif\0\0'
+EXIF_IFD_POINTER = 0x8769
+EXIF_USER_COMMENT = 0x9286
+tiff_type_sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+
+
+def decode_user_comment(data):
+    # EXIF UserComment: 8 bytes naming the encoding, then the text. webui (piexif) writes UNICODE as UTF-16 BE.
+    prefix, text = data[:8], data[8:]
+    if prefix.startswith(b'UNICODE'):
+        encoding = 'utf-16' if text[:2] in (b'\xff\xfe', b'\xfe\xff') else 'utf-16-be'
+    elif prefix.startswith(b'ASCII'):
+        encoding = 'ascii'
+    else:
+        encoding = 'utf-8'
+    return text.decode(encoding, errors='ignore').strip('\0') or None
+
+
+def read_exif_user_comment(tiff):
+    # Follow IFD0 to the Exif IFD of a TIFF structure (the EXIF payload) and decode its UserComment
+    if tiff[:2] == b'II':
+        order = '<'
+    elif tiff[:2] == b'MM':
+        order = '>'
+    else:
+        return None
+
+    def entries(offset):
+        count, = struct.unpack_from(order + 'H', tiff, offset)
+        for n in range(count):
+            yield struct.unpack_from(order + 'HHII', tiff, offset + 2 + n * 12) + (offset + 2 + n * 12 + 8,)
+
+    ifd0, = struct.unpack_from(order + 'I', tiff, 4)
+    exif_ifd = next((value for tag, _, _, value, _ in entries(ifd0) if tag == EXIF_IFD_POINTER), None)
+    if exif_ifd is None:
+        return None
+    for tag, value_type, count, value, value_offset in entries(exif_ifd):
+        if tag == EXIF_USER_COMMENT:
+            size = count * tiff_type_sizes.get(value_type, 1)
+            start = value_offset if size <= 4 else value
+            return decode_user_comment(tiff[start:start + size])
+    return None
+
+
+def read_jpeg_parameters(path):
+    # Walk the JPEG markers to the APP1 EXIF segment and return its UserComment, stopping at the start of the scan
+    # (the pixel data). Returns None when the file is not a JPEG or has no EXIF UserComment.
+    with open(path, "rb") as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xff:
+                return None
+            while marker[1] == 0xff:  # fill bytes
+                marker = marker[1:] + f.read(1)
+            if marker[1] in (0xd9, 0xda):  # end of image, start of scan
+                return None
+            if 0xd0 <= marker[1] <= 0xd7 or marker[1] == 0x01:  # no length
+                continue
+            length, = struct.unpack('>H', f.read(2))
+            if marker[1] != 0xe1:
+                f.seek(length - 2, 1)
+                continue
+            data = f.read(length - 2)
+            if data.startswith(EXIF_HEADER):
+                return read_exif_user_comment(data[len(EXIF_HEADER):])
+
+
+def read_webp_parameters(path):
+    # Walk the RIFF chunks of a WebP file to its EXIF chunk and return the UserComment, seeking over the image data.
+    # Returns None when the file is not a WebP or has no EXIF UserComment.
+    with open(path, "rb") as f:
+        header = f.read(12)
+        if header[:4] != b'RIFF' or header[8:12] != b'WEBP':
+            return None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                return None
+            chunk_type, length = struct.unpack('<4sI', chunk)
+            if chunk_type != b'EXIF':
+                f.seek(length + (length & 1), 1)
+                continue
+            data = f.read(length)
+            if data.startswith(EXIF_HEADER):
+                data = data[len(EXIF_HEADER):]
+            return read_exif_user_comment(data)
+
+
+def read_sidecar_parameters(path):
+    # Infotext saved next to the image by webui's "Create a text file next to every image" option
+    sidecar = os.path.splitext(path)[0] + ".txt"
+    try:
+        with open(sidecar, encoding="utf8", errors="ignore") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+image_readers = {b'\x89PNG': read_png_parameters, b'\xff\xd8': read_jpeg_parameters, b'RIFF': read_webp_parameters}
+
+
+def read_image_parameters(path):
+    # Fast paths for PNG, JPEG and WebP that only read the metadata, then the sidecar .txt file;
+    # other formats fall back to webui's full image decoding
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    reader = image_readers.get(magic) or image_readers.get(magic[:2])
+    if reader is not None:
+        try:
+            text = reader(path)
+        except (OSError, zlib.error, struct.error, IndexError, ValueError):
+            text = None
+        if text is not None:
+            return text
+    text = read_sidecar_parameters(path)
+    if text is not None or reader in (read_jpeg_parameters, read_webp_parameters):
+        return text
+
+    import modules.images as img
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data:
+        return None
+    return img.image_data(data)[0]
+
+
+re_param = re.compile(r'\s*([\w ]+):\s*("(?:\\.|[^\\"])+"|[^,]*)(?:,|$)')
+re_imagesize = re.compile(r"^(\d+)x(\d+)$")
+
+
+def parse_infotext(x):
+    # Same result as webui's parse_generation_parameters for the keys in arg_mapping, without importing webui
+    res = {}
+    prompt = []
+    negative_prompt = []
+    done_with_prompt = False
+
+    *lines, lastline = x.strip().split("\n")
+    params = re_param.findall(lastline)
+    if len(params) < 3:
+        lines.append(lastline)
+        params = []
+
+    for line in lines:
+        line = line.strip()
+        if line.startswith("Negative prompt:"):
+            done_with_prompt = True
+            line = line[16:].strip()
+        (negative_prompt if done_with_prompt else prompt).append(line)
+
+    res["Prompt"] = "\n".join(prompt)
+    res["Negative prompt"] = "\n".join(negative_prompt)
+
+    for k, v in params:
+        if v[:1] == '"' and v[-1:] == '"':
+            try:
+                v = json.loads(v)
+            except ValueError:
+                pass
+        m = re_imagesize.match(v)
+        if m is not None:
+            res[f"{k}-1"] = m.group(1)
+            res[f"{k}-2"] = m.group(2)
+        else:
+            res[k] = v
+
+    # Missing CLIP skip means it was set to 1 (the default)
+    res.setdefault("Clip skip", "1")
+    if "Hires resize-1" not in res:
+        res["Hires resize-1"] = 0
+        res["Hires resize-2"] = 0
+    return res
+
+
+# infotext key -> (processing attribute, converter), precomputed from arg_mapping and prompt_tags
+infotext_table = {k: (arg, prompt_tags[arg]) for k, arg in arg_mapping.items()}
+
+
+def map_parameters(res):
+    # Map the parsed infotext keys to processing attributes and convert the values
+    formated_args = {}
+    for k, v in res.items():
+        entry = infotext_table.get(k)
+        if entry is not None:
+            formated_args[entry[0]] = entry[1](v)
+    return formated_args
+
+
+class Job:
+    """A planned generation: attributes to set on the processing object, its override settings, the ids of the list
+    entries it generates (several when packed, see pack_seed_batches) and where it comes from."""
+
+    __slots__ = ('args', 'override_settings', 'ids', 'source')
+
+    def __init__(self, args, override_settings, ids=None, source=None):
+        self.args = args
+        self.override_settings = override_settings
+        self.ids = ids or []
+        self.source = source
+
+    def images(self, p):
+        return self.args.get('n_iter', p.n_iter) * self.args.get('batch_size', p.batch_size)
+
+
+class JobParser:
+    """Turns infotexts, or mapped image parameters, into Jobs the same way for all the scripts."""
+
+    def __init__(self, script_overrides=(), prepend_prompt_text='', append_prompt=False, cast_value=None):
+        if cast_value is None:
+            from modules import shared
+            cast_value = shared.opts.cast_value
+        self.cast_value = cast_value
+        self.overridden = [overrides_mapping[ovr] for ovr in script_overrides if ovr in overrides_mapping]
+        self.prepend_prompt_text = prepend_prompt_text
+        self.append_prompt = append_prompt
+
+    def parse(self, text, source=None):
+        with tracer.span('parse'):
+            return self.job(map_parameters(parse_infotext(text)), source)
+
+    def job(self, formated_args, source=None):
+        for arg in self.overridden:
+            formated_args.pop(arg, None)
+
+        formated_args['enable_hr'] = (formated_args.get('hr_scale', 0) > 0 or formated_args.get('hr_resize_x', 0) > 0
+                                      or formated_args.get('hr_resize_y', 0) > 0)
+
+        if formated_args.get('face_restoration_model', False):
+            formated_args['restore_faces'] = True
+
+        seed_resize = formated_args.pop('seed_resize', None)
+        if seed_resize:
+            formated_args['seed_resize_from_w'] = seed_resize[0]
+            formated_args['seed_resize_from_h'] = seed_resize[1]
+
+        override_settings = {}
+        for setting_name in override_list:
+            value = formated_args.pop(setting_name, None)
+            if value is not None:
+                override_settings[setting_name] = self.cast_value(setting_name, value)
+
+        if self.prepend_prompt_text != '':
+            if self.append_prompt:
+                formated_args['prompt'] = formated_args.get('prompt', '') + ' ,' + self.prepend_prompt_text
+            else:
+                formated_args['prompt'] = self.prepend_prompt_text + ', ' + formated_args.get('prompt', '')
+
+        return Job(formated_args, override_settings, source=source)
+
+
+extension_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+cache_path = os.path.join(extension_dir, "parameters_cache.sqlite3")
+cache_max_entries = 200000
+cache_version = 2  # bump when arg_mapping or prompt_tags change the shape of the cached args
+cache_busy_timeout = 30  # seconds a write waits for another user of the cache file
+
+
+class ParametersCache:
+    """Persistent (path, size, mtime) -> mapped args cache, evicting the least recently used entries.
+    Several extractions can share the file (UI, API and hot folder batches): it is in WAL mode and every write is
+    committed at once, so none of them holds the write lock for its whole run."""
+
+    def __init__(self, path=None, max_entries=cache_max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.touched = {}
+        self.conn = sqlite3.connect(path or cache_path, timeout=cache_busy_timeout, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != cache_version:
+            self.conn.execute("DROP TABLE IF EXISTS parameters")
+            self.conn.execute(f"PRAGMA user_version = {cache_version}")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS parameters (path TEXT PRIMARY KEY, size INTEGER, "
+                          "mtime INTEGER, args TEXT, last_used REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS parameters_last_used ON parameters (last_used)")
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, path, size, mtime):
+        with self.lock:
+            row = self.conn.execute("SELECT args FROM parameters WHERE path = ? AND size = ? AND mtime = ?",
+                                    (path, size, mtime)).fetchone()
+            if row is None:
+                return None
+            self.touched[path] = time.time()
+        return json.loads(row[0])
+
+    def put(self, path, size, mtime, args):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO parameters VALUES (?, ?, ?, ?, ?)",
+                              (path, size, mtime, json.dumps(args), time.time()))
+            self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM parameters")
+            self.conn.commit()
+            self.touched.clear()
+
+    def close(self):
+        with self.lock:
+            try:
+                self.conn.executemany("UPDATE parameters SET last_used = ? WHERE path = ?",
+                                      [(t, path) for path, t in self.touched.items()])
+                self.conn.execute("DELETE FROM parameters WHERE path NOT IN "
+                                  "(SELECT path FROM parameters ORDER BY last_used DESC LIMIT ?)",
+                                  (self.max_entries,))
+                self.conn.commit()
+            finally:
+                self.conn.close()
+
+
+def invalidate_parameters_cache():
+    with ParametersCache() as cache:
+        cache.clear()
+    print("Parameters cache invalidated.")
+
+
+def read_image_args(path, cache=None):
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
+        raise FileNotFoundError(f"not a file: {path}")
+
+    if cache is not None:
+        with tracer.span('read', 'cache lookup'):
+            formated_args = cache.get(path, st.st_size, st.st_mtime_ns)
+        if formated_args is not None:
+            return formated_args
+
+    with tracer.span('read', path=path):
+        text = read_image_parameters(path)
+    if not text:
+        raise ValueError(f"no generation parameters in {path}")
+
+    with tracer.span('parse'):
+        formated_args = map_parameters(parse_infotext(text))
+
+    if cache is not None:
+        cache.put(path, st.st_size, st.st_mtime_ns, formated_args)
+    return formated_args
+
+
+def extract_parameters(items, workers=8, cache_file=None, path_of=None):
+    # Read and map the images with a bounded thread pool, yielding (item, formated_args, error) in source order.
+    # items are paths, or anything path_of turns into a path. At most workers * 4 files are in flight so a huge
+    # list is not queued all at once. cache_file defaults to cache_path, '' disables the cache.
+    workers = max(1, int(workers))
+    cache = ParametersCache(cache_file) if cache_file != '' else None
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batchscripts-reader") as pool:
+            pending = deque()
+            for item in items:
+                path = item if path_of is None else path_of(item)
+                pending.append((item, path, pool.submit(read_image_args, path, cache)))
+                if len(pending) >= workers * 4:
+                    yield _extraction_result(*pending.popleft())
+            while pending:
+                yield _extraction_result(*pending.popleft())
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+def _extraction_result(item, path, future):
+    try:
+        return item, future.result(), None
+    except Exception as e:
+        print(f"Skipping {path}: {e}")
+        return item, None, e
+
+
+def iter_file_blocks(path):
+    # Lazily split a text file into blank line separated blocks, reading it in buffered chunks
+    with open(path, encoding="utf8", errors="ignore", buffering=1024 * 1024) as f:
+        block = []
+        for line in f:
+            line = line.rstrip("\r\n")
+            if line.strip():
+                block.append(line)
+            elif block:
+                yield "\n".join(block)
+                block = []
+        if block:
+            yield "\n".join(block)
+
+
+def iter_file_lines(path):
+    with open(path, encoding="utf8", errors="ignore", buffering=1024 * 1024) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def parse_date(text):
+    return datetime.datetime.fromisoformat(text.strip()).timestamp() if text and text.strip() else None
+
+
+def scan_dates(options):
+    # The modified after and before bounds of the folder scan, checked before the run starts
+    try:
+        return parse_date(options.scan_after), parse_date(options.scan_before)
+    except ValueError as e:
+        raise ValueError(f"Invalid modification date for the folder scan: {e} (expected YYYY-MM-DD or "
+                         f"YYYY-MM-DD HH:MM)") from e
+
+
+def scan_files(root, extensions=(), max_depth=0, after=None, before=None, depth=1):
+    # Recursively yield the files under root in name order, with os.scandir so no extra stat is needed per entry.
+    # max_depth 1 only lists root, 0 has no limit. after and before are modification timestamps.
+    try:
+        with os.scandir(root) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except OSError as e:
+        print(f"Can't scan {root}: {e}")
+        return
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if not max_depth or depth < max_depth:
+                yield from scan_files(entry.path, extensions, max_depth, after, before, depth + 1)
+        elif entry.is_file():
+            if extensions and not entry.name.lower().endswith(extensions):
+                continue
+            if after is not None or before is not None:
+                mtime = entry.stat().st_mtime
+                if (after is not None and mtime < after) or (before is not None and mtime >= before):
+                    continue
+            yield entry.path
+
+
+def expand_path(path, options):
+    # A directory or a glob pattern (with ** for any depth) stands for the image files it matches. An existing file is
+    # taken as is, even when its name has glob characters such as "img [1].png".
+    extensions = tuple(x.strip().lower() for x in options.scan_extensions.split(',') if x.strip())
+    after, before = scan_dates(options)
+
+    if os.path.isfile(path):
+        yield path
+    elif os.path.isdir(path):
+        yield from scan_files(path, extensions, int(options.scan_depth), after, before)
+    elif glob.has_magic(path):
+        parts = path.replace('\\', '/').split('/')
+        static = next(n for n, part in enumerate(parts) if glob.has_magic(part))
+        root = '/'.join(parts[:static]) or ('/' if parts[0] == '' and static else '.')
+        depth = int(options.scan_depth) if '**' in parts else len(parts) - static
+        patterns = {os.path.normpath(path), os.path.normpath(path.replace('**/', '').replace('**\\', ''))}
+        for f in scan_files(root, extensions, depth, after, before):
+            f = os.path.normpath(f)
+            if any(fnmatch.fnmatch(f, pattern) for pattern in patterns):
+                yield f
+    else:
+        yield path
+
+
+def source_entries(prompt_txt, options, blocks=False):
+    # Entries of the batch: blocks (batchfrominfo) or lines (imagelists) of the server side source file when one is
+    # set, of prompt_txt otherwise, restricted to the [entry_start, entry_stop) range.
+    if options.source_file:
+        entries = iter_file_blocks(options.source_file) if blocks else iter_file_lines(options.source_file)
+    elif blocks:
+        entries = (block for block in prompt_txt.split('\n\n') if block.strip())
+    else:
+        entries = (x for x in (x.strip() for x in prompt_txt.splitlines()) if len(x) > 0)
+    return itertools.islice(entries, int(options.entry_start), int(options.entry_stop) or None)
+
+
+def source_key(title, prompt_txt, script_overrides, prepend_prompt_text, append_prompt, options):
+    # Identifies the inputs of a batch, see Journal
+    source = prompt_txt
+    if options.source_file:
+        st = os.stat(options.source_file)
+        source = [options.source_file, st.st_size, st.st_mtime_ns]
+    return run_key(title, source, script_overrides, prepend_prompt_text, append_prompt, int(options.entry_start),
+                   int(options.entry_stop))
+
+
+def plan_jobs(script, text, parser, options, p=None):
+    # Jobs of a batch given as the scripts take it: image lists (A), "path" batch_size lists (B) or infotexts
+    # (frominfo), for the scripts, batchscripts_cli.py and the API. With p, the number of entries read and of jobs and
+    # images planned is printed once the whole source is read.
+    stats = {}
+    job_total = 0
+    image_total = 0
+    for job in _plan_entries(script, text, parser, options, stats):
+        job_total += 1
+        if p is not None:
+            image_total += job.images(p)
+        yield job
+
+    if p is not None:
+        entries = "entries" if script == "frominfo" else "lines"
+        print(f"Read {stats['entries']} {entries}, planned {job_total} jobs generating {image_total} images.")
+
+
+def _plan_entries(script, text, parser, options, stats):
+    # Entries that can't be parsed or converted are skipped like unreadable images, so that planning, which runs
+    # while the batch is generating, doesn't stop the batch partway through.
+    stats['entries'] = 0
+    if script == "frominfo":
+        entries = source_entries(text, options, blocks=True)
+        for n, block in enumerate(entries, int(options.entry_start)):
+            stats['entries'] += 1
+            try:
+                job = parser.parse(block, n)
+            except Exception as e:
+                print(f"Skipping entry {n}: {e}")
+                continue
+            yield job
+        return
+
+    def entries():
+        for line in source_entries(text, options):
+            stats['entries'] += 1
+            batch_size = None
+            if script == "B":
+                if not line.startswith('"'):
+                    continue
+                parts = line.split('" ')
+                line = parts[0].strip('"')
+                batch_size = parts[1].strip('"') if len(parts) > 1 else '1'
+            for path in expand_path(line, options):
+                yield path, batch_size
+
+    results = extract_parameters(entries(), options.reader_threads, path_of=lambda entry: entry[0])
+    for (path, batch_size), formated_args, error in results:
+        if error is not None:
+            continue
+        if batch_size is not None:
+            try:
+                formated_args['batch_size'] = int(batch_size)
+            except ValueError:
+                continue
+        try:
+            job = parser.job(formated_args, path)
+        except Exception as e:
+            print(f"Skipping {path}: {e}")
+            continue
+        yield job
+
+
+def run_in_background(iterable, maxsize=64):
+    # Consume iterable in a background thread so planning overlaps with generation.
+    # Exceptions raised while planning are re-raised in the consuming thread.
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((done, e))
+        else:
+            put((done, None))
+
+    threading.Thread(target=worker, name="batchscripts-planner", daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def group_by_model(jobs, model_key, lookahead=64, on_switch=None):
+    # Yield (model, job) so jobs sharing a checkpoint run together.
+    # Jobs for the current model are yielded as soon as they are planned; when there are none, up to
+    # lookahead jobs are buffered to pick the next model, the one with most pending jobs.
+    # on_switch(model, upcoming) is called on every change with the other buffered models, most pending first.
+    jobs = iter(jobs)
+    buffered = {}
+    pending = 0
+    exhausted = False
+    current = None
+    while True:
+        while not exhausted and not buffered.get(current) and pending < max(1, lookahead):
+            try:
+                job = next(jobs)
+            except StopIteration:
+                exhausted = True
+                break
+            buffered.setdefault(model_key(job), deque()).append(job)
+            pending += 1
+
+        if not buffered.get(current):
+            buffered.pop(current, None)
+            if not buffered:
+                return
+            current = max(buffered, key=lambda model: len(buffered[model]))
+            if on_switch is not None:
+                upcoming = sorted((m for m in buffered if m != current), key=lambda m: -len(buffered[m]))
+                on_switch(current, upcoming)
+
+        pending -= 1
+        yield current, buffered[current].popleft()
+
+
+locality_keys = ['override settings', 'hires upscaler', 'face restoration', 'prompt conditioning', 'size']
+
+
+def conditioning_key(job):
+    # What webui's cache of the last computed conditioning (cached_c and cached_uc in process_images) depends on,
+    # within a checkpoint: the final prompts, the steps (prompt editing schedules) and CLIP skip
+    args = job.args
+    return (str(args.get('prompt', '')), str(args.get('negative_prompt', '')), args.get('steps', 0),
+            repr(job.override_settings.get('CLIP_stop_at_last_layers')))
+
+
+def locality_key(job):
+    # Settings that cost a reload, a model swap or a recomputation when they change between two jobs, most
+    # expensive first
+    args = job.args
+    return (repr(sorted(job.override_settings.items())),
+            str(args.get('hr_upscaler', '')) if args.get('enable_hr') else '',
+            str(args.get('face_restoration_model', '')) if args.get('restore_faces') else '',
+            conditioning_key(job),
+            (args.get('width', 0), args.get('height', 0)))
+
+
+class SwitchCounter:
+    def __init__(self):
+        self.last = None
+        self.switches = [0] * len(locality_keys)
+
+    def add(self, key):
+        if self.last is not None:
+            for n, (a, b) in enumerate(zip(self.last, key)):
+                self.switches[n] += a != b
+        self.last = key
+
+
+class ConditioningCache:
+    """Counts the jobs webui's cache of the last computed conditioning would serve, run in the order they are added."""
+
+    def __init__(self):
+        self.last = None
+        self.jobs = 0
+        self.hits = 0
+
+    def add(self, model, key):
+        key = (model, key[3])
+        self.jobs += 1
+        self.hits += key == self.last
+        self.last = key
+
+    def rate(self):
+        return self.hits / self.jobs if self.jobs else 0.0
+
+
+def order_by_locality(jobs, lookahead=64, stats=None):
+    # Sort the (model, job) entries of each checkpoint group by locality_key, a window of lookahead jobs at a time.
+    # Each window starts with the jobs sharing the settings of the last job of the previous one, and jobs with the
+    # same prompts end up next to each other so their text encoding is computed once.
+    # The expected conditioning cache hit rate is printed at the end, and set in stats when given.
+    original = SwitchCounter()
+    ordered = SwitchCounter()
+    original_cache = ConditioningCache()
+    ordered_cache = ConditioningCache()
+    window = []
+    current = None
+
+    def flush():
+        window.sort(key=lambda entry: (entry[0] != ordered.last, entry[0]))
+        for key, job in window:
+            ordered.add(key)
+            ordered_cache.add(current, key)
+            yield current, job
+        window.clear()
+
+    for model, job in jobs:
+        if model != current or len(window) >= max(1, lookahead):
+            yield from flush()
+            current = model
+        key = locality_key(job)
+        original.add(key)
+        original_cache.add(model, key)
+        window.append((key, job))
+    yield from flush()
+
+    # sorting by the more expensive settings can add switches of the cheaper ones, both counts are reported
+    if original.switches != ordered.switches:
+        print("Job ordering, switches in list order -> run order: " +
+              ", ".join(f"{name} {a} -> {b}" for name, a, b in zip(locality_keys, original.switches, ordered.switches))
+              + ".")
+    if ordered_cache.jobs:
+        print(f"Prompt conditioning cache: {ordered_cache.hits} of {ordered_cache.jobs} jobs reuse the text encoding "
+              f"of the previous job, expected hit rate {ordered_cache.rate():.0%} ({original_cache.rate():.0%} in list "
+              f"order).")
+    if stats is not None:
+        stats.update(conditioning_jobs=ordered_cache.jobs, conditioning_hits=ordered_cache.hits,
+                     conditioning_hits_in_order=original_cache.hits)
+
+
+def is_packable(args, p):
+    # A job can share a batch if it generates a single image from an explicit seed
+    seed = args.get('seed', None)
+    return (isinstance(seed, int) and seed != -1
+            and args.get('batch_size', p.batch_size) == 1 and args.get('n_iter', p.n_iter) == 1
+            and not args.get('subseed_strength', 0))
+
+
+def pack_key(job):
+    return (tuple(sorted((k, repr(v)) for k, v in job.args.items() if k != 'seed')),
+            tuple(sorted((k, repr(v)) for k, v in job.override_settings.items())))
+
+
+def pack_jobs(jobs):
+    if len(jobs) == 1:
+        return jobs[0]
+    args = dict(jobs[0].args)
+    args['seed'] = [job.args['seed'] for job in jobs]
+    args['batch_size'] = len(jobs)
+    return Job(args, jobs[0].override_settings, [job_id for job in jobs for job_id in job.ids],
+               [job.source for job in jobs])
+
+
+def pack_seed_batches(jobs, p, max_batch_size=1, lookahead=64):
+    # Merge (model, job) entries that only differ by their seed into one job with batch_size > 1 and a list of seeds,
+    # so process_images generates them in a single call. Images come back in the order of the merged entries.
+    if max_batch_size <= 1:
+        yield from jobs
+        return
+
+    pending = {}
+    pending_count = 0
+    current = None
+    for model, job in jobs:
+        if model != current:
+            for batch in pending.values():
+                yield current, pack_jobs(batch)
+            pending.clear()
+            pending_count = 0
+            current = model
+
+        if not is_packable(job.args, p):
+            yield model, job
+            continue
+
+        batch = pending.setdefault(pack_key(job), [])
+        batch.append(job)
+        pending_count += 1
+        if len(batch) >= max_batch_size:
+            pending_count -= len(batch)
+            yield model, pack_jobs(pending.pop(pack_key(job)))
+        elif pending_count > lookahead:
+            oldest = next(iter(pending))
+            pending_count -= len(pending[oldest])
+            yield model, pack_jobs(pending.pop(oldest))
+
+    for batch in pending.values():
+        yield current, pack_jobs(batch)
+
+
+journal_dir = os.path.join(extension_dir, "journals")
+
+
+def run_key(*inputs):
+    # Identifies a batch by the inputs of its script, to find its journal again
+    return hashlib.sha1(json.dumps(inputs, default=str).encode('utf8')).hexdigest()
+
+
+def job_key(args, override_settings):
+    data = json.dumps([args, override_settings], sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+
+resolved_attributes = ['prompt', 'negative_prompt', 'seed', 'steps', 'cfg_scale', 'sampler_name', 'width', 'height',
+                       'batch_size', 'n_iter']
+
+
+def resolve_args(p, args):
+    # The attributes a job runs with: its own, and those of p for the ones it leaves out or overrides
+    resolved = {k: getattr(p, k, None) for k in resolved_attributes}
+    resolved.update(args)
+    return resolved
+
+
+class Journal:
+    """Records the completed jobs of a batch, so that a run that died or was interrupted can be resumed.
+    Jobs are identified by their parameters and occurrence in the list, not their position in the run order. With p,
+    the parameters are resolved against it, so that jobs are run again when the UI values they take change."""
+
+    def __init__(self, key, resume=False, p=None):
+        self.p = p
+        self.path = os.path.join(journal_dir, f"{key}.txt")
+        self.completed = set()
+        self.skipped = 0
+        if resume and os.path.isfile(self.path):
+            with open(self.path, encoding="utf8") as f:
+                self.completed = {line.strip() for line in f}
+        os.makedirs(journal_dir, exist_ok=True)
+        self.file = open(self.path, "a" if resume else "w", encoding="utf8")
+        self.lock = threading.Lock()  # jobs are filtered in the planning thread and completed in the main one
+
+    def track(self, jobs):
+        # Give each job its id, leaving out the completed ones
+        occurrences = {}
+        for job in jobs:
+            args = job.args if self.p is None else resolve_args(self.p, job.args)
+            key = job_key(args, job.override_settings)
+            occurrences[key] = occurrences.get(key, 0) + 1
+            job_id = f"{key}-{occurrences[key]}"
+            if job_id in self.completed:
+                self.skipped += 1
+                continue
+            job.ids = [job_id]
+            yield job
+
+    def complete(self, job_ids):
+        with self.lock:
+            self.file.writelines(job_id + "\n" for job_id in job_ids)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+        if self.skipped:
+            print(f"Resumed batch: skipped {self.skipped} jobs already completed.")
+
+
+outputs_index_path = os.path.join(extension_dir, "outputs_index.sqlite3")
+
+
+checkpoint_index_path = os.path.join(extension_dir, "checkpoint_index.sqlite3")
+checkpoint_hash_threads = 4
+hash_chunk_size = 64 * 1024 * 1024
+
+
+def legacy_model_hash(filename):
+    # The 8 character "Model hash" of older webui versions: sha256 of 64 KB at 1 MB into the file
+    with open(filename, "rb") as f:
+        f.seek(0x100000)
+        return hashlib.sha256(f.read(0x10000)).hexdigest()[:8]
+
+
+def file_sha256(filename):
+    # sha256 of a memory mapped file; hashlib releases the GIL, so several files hash in parallel threads
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return sha256.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, "madvise"):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(m) as view:
+                for offset in range(0, len(view), hash_chunk_size):
+                    sha256.update(view[offset:offset + hash_chunk_size])
+    return sha256.hexdigest()
+
+
+class CheckpointIndex:
+    """Persistent index of the checkpoint files known to webui: their old short hash and sha256, recomputed only when
+    the size or modification time of a file changes. Resolves the "Model hash" of infotexts (old hash, sha256 or a
+    prefix of it, name or filename) to webui's checkpoint info. The full file hashes are only computed when a name
+    can't be resolved otherwise, for all the files missing one at once, in parallel."""
+
+    def __init__(self, path=None, threads=checkpoint_hash_threads):
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path or checkpoint_index_path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS checkpoints (filename TEXT PRIMARY KEY, size INTEGER, "
+                          "mtime_ns INTEGER, model_hash TEXT, sha256 TEXT)")
+        self.infos = {}
+        self.rows = {}
+        self.aliases = {}
+        self.refreshed = False
+
+    def refresh(self):
+        # Stat every checkpoint webui lists, rehashing (old hash only) the new and modified ones
+        from modules import sd_models as sdm
+
+        stored = {row[0]: row[1:] for row in self.conn.execute("SELECT * FROM checkpoints")}
+        self.infos = {}
+        self.rows = {}
+        stale = []
+        for info in list(getattr(sdm, 'checkpoints_list', {}).values()):
+            try:
+                st = os.stat(info.filename)
+            except OSError:
+                continue
+            self.infos[info.filename] = info
+            row = stored.get(info.filename)
+            if row is not None and row[:2] == (st.st_size, st.st_mtime_ns):
+                self.rows[info.filename] = row
+            else:
+                stale.append((info.filename, st))
+
+        with ThreadPoolExecutor(self.threads) as pool:
+            for (filename, st), model_hash in zip(stale, pool.map(legacy_model_hash, [x[0] for x in stale])):
+                self.rows[filename] = (st.st_size, st.st_mtime_ns, model_hash, None)
+        self.conn.executemany("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?)",
+                              [(filename, *self.rows[filename]) for filename, _ in stale])
+        self.conn.commit()
+        self.refreshed = True
+        self.build_aliases()
+
+    def hash_files(self):
+        # Full sha256 of the checkpoints missing one, returns whether there were any
+        missing = [filename for filename, row in self.rows.items() if row[3] is None]
+        if not missing:
+            return False
+        started = time.time()
+        with ThreadPoolExecutor(self.threads) as pool:
+            for filename, sha256 in zip(missing, pool.map(file_sha256, missing)):
+                self.rows[filename] = self.rows[filename][:3] + (sha256,)
+                self.conn.execute("UPDATE checkpoints SET sha256 = ? WHERE filename = ?", (sha256, filename))
+        self.conn.commit()
+        print(f"Hashed {len(missing)} checkpoints in {time.time() - started:.0f} s.")
+        self.build_aliases()
+        return True
+
+    def build_aliases(self):
+        self.aliases = {}
+        for filename, info in self.infos.items():
+            _, _, model_hash, sha256 = self.rows[filename]
+            stem = os.path.splitext(os.path.basename(filename))[0]
+            for alias in (info.title, getattr(info, 'name', None), getattr(info, 'model_name', None),
+                          os.path.basename(filename), stem, model_hash, sha256,
+                          sha256[:10] if sha256 else None):
+                if alias:
+                    self.aliases.setdefault(alias.lower(), info)
+
+    def lookup(self, name):
+        name = name.lower()
+        if name in self.aliases:
+            return self.aliases[name]
+        if len(name) >= 8:
+            for filename, row in self.rows.items():
+                if row[3] is not None and row[3].startswith(name):
+                    return self.infos[filename]
+        return None
+
+    def sha256(self, info):
+        # The sha256 of a checkpoint hashed by the index, kept here rather than on webui's checkpoint info
+        row = self.rows.get(info.filename)
+        return row[3] if row is not None else None
+
+    def resolve(self, names):
+        # {name: checkpoint info, or None when no checkpoint matches}, for all the names at once
+        from modules import sd_models as sdm
+
+        with self.lock:
+            if not self.refreshed:
+                self.refresh()
+            resolved = {name: self.lookup(name) for name in names}
+            for name in [name for name, info in resolved.items() if info is None]:
+                resolved[name] = sdm.get_closet_checkpoint_match(name)
+            if None in resolved.values() and self.hash_files():
+                for name in [name for name, info in resolved.items() if info is None]:
+                    resolved[name] = self.lookup(name)
+            return resolved
+
+    def close(self):
+        self.conn.close()
+
+
+checkpoint_index = None
+
+
+def resolve_checkpoints(names):
+    # Bulk lookup of checkpoint names and hashes in the persistent CheckpointIndex
+    global checkpoint_index
+    if checkpoint_index is None:
+        checkpoint_index = CheckpointIndex()
+    return checkpoint_index.resolve(set(names))
+
+
+def refresh_checkpoint_index():
+    # Called when a batch starts: the checkpoints are stat'ed again on the next lookup, so that files added, replaced
+    # or touched since the previous batch are rehashed
+    if checkpoint_index is not None:
+        with checkpoint_index.lock:
+            checkpoint_index.refreshed = False
+
+
+def resolve_checkpoint(x):
+    return resolve_checkpoints([x])[x]
+
+
+def checkpoint_hash(x):
+    info = resolve_checkpoint(x)
+    if info is None:
+        return x
+    return (checkpoint_index.sha256(info) or getattr(info, 'sha256', None) or getattr(info, 'hash', None)
+            or info.title)
+
+
+class OutputIndex:
+    """Content addressed index of generated jobs: the fingerprint of a fully resolved job (parameters, override
+    settings and checkpoint hash) maps to its output files. Jobs rendered by a previous run are skipped and their
+    outputs linked into the current output folder, duplicates within a run are generated once."""
+
+    def __init__(self, p, fallback_checkpoint, path=None):
+        self.p = p
+        self.fallback_checkpoint = fallback_checkpoint
+        self.conn = sqlite3.connect(path or outputs_index_path, check_same_thread=False)
+        self.lock = threading.Lock()  # filter runs in the planning thread, record in the main one
+        self.conn.execute("CREATE TABLE IF NOT EXISTS outputs (fingerprint TEXT PRIMARY KEY, files TEXT, "
+                          "duration REAL)")
+        self.checkpoints = {}
+        self.fingerprints = {}
+        self.seen = set()
+        self.linked = 0
+        self.duplicates = 0
+        self.saved_time = 0.0
+        self.durations = []
+
+    def fingerprint(self, args, override_settings):
+        resolved = resolve_args(self.p, args)
+        if resolved['seed'] is None or resolved['seed'] == -1:
+            return None  # random seed, every run is a different image
+
+        model = args.get('sd_model_hash') or self.fallback_checkpoint
+        if model not in self.checkpoints:
+            self.checkpoints[model] = checkpoint_hash(model)
+        resolved['sd_model_hash'] = self.checkpoints[model]
+        return job_key(resolved, override_settings)
+
+    def filter(self, jobs, journal):
+        for job in jobs:
+            fingerprint = self.fingerprint(job.args, job.override_settings)
+            if fingerprint is None:
+                yield job
+                continue
+
+            if fingerprint in self.seen:
+                self.duplicates += 1
+                journal.complete(job.ids)
+                continue
+            self.seen.add(fingerprint)
+
+            with self.lock:
+                row = self.conn.execute("SELECT files, duration FROM outputs WHERE fingerprint = ?",
+                                        (fingerprint,)).fetchone()
+            if row is not None and self.link(json.loads(row[0])):
+                self.linked += 1
+                self.saved_time += row[1]
+                journal.complete(job.ids)
+                continue
+
+            for job_id in job.ids:
+                self.fingerprints[job_id] = fingerprint
+            yield job
+
+    def link(self, files):
+        if not files or not all(os.path.isfile(f) for f in files):
+            return False
+        os.makedirs(self.p.outpath_samples, exist_ok=True)
+        for f in files:
+            target = os.path.join(self.p.outpath_samples, os.path.basename(f))
+            if os.path.exists(target):
+                continue
+            try:
+                os.link(f, target)
+            except OSError:
+                shutil.copy2(f, target)
+        return True
+
+    def record(self, job_ids, images, duration):
+        # images of a packed job are in the order of its job ids
+        self.durations.append(duration / max(1, len(job_ids)))
+        per_job = max(1, len(images) // max(1, len(job_ids)))
+        with self.lock:
+            self._record(job_ids, images, duration, per_job)
+
+    def _record(self, job_ids, images, duration, per_job):
+        for n, job_id in enumerate(job_ids):
+            fingerprint = self.fingerprints.pop(job_id, None)
+            files = [getattr(image, 'already_saved_as', None) for image in images[n * per_job:(n + 1) * per_job]]
+            if fingerprint is None or not files or None in files:
+                continue
+            self.conn.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?)",
+                              (fingerprint, json.dumps(files), duration / len(job_ids)))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+        if self.linked or self.duplicates:
+            average = sum(self.durations) / len(self.durations) if self.durations else 0.0
+            saved = self.saved_time + self.duplicates * average
+            print(f"Skipped {self.linked} jobs already generated by previous runs and {self.duplicates} duplicate "
+                  f"jobs, saving about {saved:.0f} s of generation.")
+
+
+timings_path = os.path.join(extension_dir, "timings.json")
+default_timings = {'seconds_per_megapixel_step': 0.3, 'seconds_per_switch': 10.0}
+timings_decay = 0.8  # weight of the previous runs when a new one is recorded
+plan_rows = 100  # checkpoint groups listed by a dry run
+
+
+def load_timings():
+    try:
+        with open(timings_path, encoding="utf8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def record_timings(generation_time, cost, switch_time, switches):
+    # Fold the measurements of a run into the totals used to calibrate the runtime estimates
+    totals = load_timings()
+    totals['runs'] = totals.get('runs', 0) + 1
+    for name, value in [('generation_time', generation_time), ('cost', cost), ('switch_time', switch_time),
+                        ('switches', switches)]:
+        totals[name] = totals.get(name, 0) * timings_decay + value
+    try:
+        with open(timings_path, "w", encoding="utf8") as f:
+            json.dump(totals, f)
+    except OSError as e:
+        print(f"Could not record the timings of the run: {e}")
+
+
+def calibrated_timings():
+    # (seconds per megapixel-step, seconds per checkpoint switch, number of past runs they come from)
+    totals = load_timings()
+    rate = default_timings['seconds_per_megapixel_step']
+    per_switch = default_timings['seconds_per_switch']
+    if totals.get('cost', 0) > 0:
+        rate = totals['generation_time'] / totals['cost']
+    if totals.get('switches', 0) > 0:
+        per_switch = totals['switch_time'] / totals['switches']
+    return rate, per_switch, totals.get('runs', 0)
+
+
+class CheckpointPrefetcher:
+    """Reads the checkpoint of the next model group in a background thread while the current group generates,
+    so that switching to it is served from the page cache. Checkpoints larger than the RAM budget are skipped."""
+
+    chunk_size = 16 * 1024 * 1024
+
+    def __init__(self, budget_mb=0):
+        self.budget = int(budget_mb) * 1024 * 1024
+        self.stop = threading.Event()
+        self.thread = None
+        self.filename = None
+
+    def prefetch(self, x):
+        if self.budget <= 0:
+            return
+        info = resolve_checkpoint(x)
+        if info is None or info.filename == self.filename:
+            return
+        try:
+            size = os.path.getsize(info.filename)
+        except OSError:
+            return
+        if size > self.budget:
+            print(f"Not prefetching {info.title}: {size // 2 ** 20} MB exceeds the prefetch budget.")
+            return
+
+        self.cancel()
+        self.filename = info.filename
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.read, args=(info.filename, self.stop),
+                                       name="batchscripts-prefetch", daemon=True)
+        self.thread.start()
+
+    def read(self, filename, stop):
+        try:
+            with open(filename, "rb", buffering=0) as f:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                while not stop.is_set() and f.read(self.chunk_size):
+                    pass
+        except OSError as e:
+            print(f"Checkpoint prefetch failed for {filename}: {e}")
+
+    def cancel(self):
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.thread = None
+        self.filename = None
+
+    def cancel_other(self, x):
+        # Stop the read in flight unless it is for x, the checkpoint about to be loaded
+        if self.filename is not None:
+            info = resolve_checkpoint(x)
+            if info is None or info.filename != self.filename:
+                self.cancel()
+
+
+def apply_checkpoint(x):
+    from modules import shared
+    from modules import sd_models as sdm
+
+    info = resolve_checkpoint(x)
+    if info is None:
+        raise RuntimeError(f"Unknown checkpoint: {x}")
+    sdm.reload_model_weights(shared.sd_model, info)
+
+
+def schedule_jobs(jobs, p, options, fallback_checkpoint, on_switch=None, stats=None):
+    # The run order of the jobs, as (model, job): grouped by checkpoint, sorted for locality and packed.
+    # Jobs without a model hash, or using the fallback checkpoint, have None as model. See order_by_locality for
+    # stats.
+    def model_key(job):
+        model = job.args.get('sd_model_hash')
+        return None if model == fallback_checkpoint else model
+
+    grouped = group_by_model(jobs, model_key, options.lookahead, on_switch)
+    if not options.keep_order:
+        grouped = order_by_locality(grouped, options.lookahead, stats)
+    return pack_seed_batches(grouped, p, options.max_batch_size, options.lookahead)
+
+
+shard_manifest_filename = "batchscripts_shard_{}_of_{}.jsonl"
+
+
+shard_snap = 0.05  # a shard boundary moves to the nearest checkpoint group boundary within this fraction of a share
+
+
+def shard_jobs(jobs, p, shard, shards):
+    # Deterministic partition of the jobs: every instance given the same list and settings computes the same one.
+    # The checkpoint groups, most expensive first, are laid end to end and cut into shards of equal estimated cost,
+    # at a group boundary when one is close, so at most shards - 1 groups are split between two instances.
+    # Returns the jobs of shard (1 based) in list order and the estimated cost of every shard.
+    jobs = list(jobs)
+    costs = [job_cost(job.args, p) for job in jobs]
+    groups = {}
+    for n, job in enumerate(jobs):
+        groups.setdefault(str(job.args.get('sd_model_hash')), []).append(n)
+    group_costs = {model: sum(costs[n] for n in members) for model, members in groups.items()}
+
+    starts = {}
+    group_starts = []
+    position = 0.0
+    for model in sorted(groups, key=lambda m: (-group_costs[m], m)):
+        group_starts.append(position)
+        for n in groups[model]:
+            starts[n] = position
+            position += costs[n]
+    job_starts = sorted(starts.values())
+
+    share = position / shards
+    cuts = []
+    for k in range(1, shards):
+        ideal = k * share
+        nearest_group = min(group_starts, key=lambda x: abs(x - ideal), default=ideal)
+        if abs(nearest_group - ideal) <= shard_snap * share:
+            cuts.append(nearest_group)
+        else:
+            cuts.append(min(job_starts, key=lambda x: abs(x - ideal)))
+
+    loads = [0.0] * shards
+    selected = []
+    for n in range(len(jobs)):
+        target = bisect.bisect_right(cuts, starts[n])
+        loads[target] += costs[n]
+        if target == shard - 1:
+            selected.append(jobs[n])
+    return selected, loads
+
+
+def shard_options(options):
+    # (shard, shards) of the batch options, (1, 1) when not sharded
+    shards = max(1, int(options.shard_count))
+    shard = int(options.shard_index)
+    if not 1 <= shard <= shards:
+        raise ValueError(f"Shard {shard} of {shards} does not exist, shards are numbered from 1")
+    return shard, shards
+
+
+class ShardManifest:
+    """Manifest of one shard of a batch, written next to its outputs: the partition, the planned jobs with their source
+    and model, then the output files of every completed job, so the outputs of all shards can be merged afterwards."""
+
+    def __init__(self, p, shard, shards, key, resume=False):
+        self.p = p
+        self.shard = shard
+        self.shards = shards
+        self.key = key
+        os.makedirs(p.outpath_samples, exist_ok=True)
+        self.path = os.path.join(p.outpath_samples, shard_manifest_filename.format(shard, shards))
+        self.file = open(self.path, "a" if resume else "w", encoding="utf8")
+        self.lock = threading.Lock()  # jobs are planned in the planning thread and recorded in the main one
+
+    def write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry, default=str) + "\n")
+            self.file.flush()
+
+    def plan(self, jobs):
+        selected, loads = shard_jobs(jobs, self.p, self.shard, self.shards)
+        print(f"Shard {self.shard} of {self.shards}: {len(selected)} jobs, estimated cost of the shards in "
+              f"megapixel-steps: " + ", ".join(f"{load:.0f}" for load in loads))
+        self.write({"batch": self.key, "shard": self.shard, "shards": self.shards, "jobs": len(selected),
+                    "estimated_costs": [round(load, 1) for load in loads]})
+        for job in selected:
+            self.write({"planned": job.source, "model": job.args.get('sd_model_hash'), "seed": job.args.get('seed')})
+        yield from selected
+
+    def record(self, job, images):
+        # images of a packed job are in the order of its sources
+        sources = job.source if isinstance(job.source, list) else [job.source]
+        per_source = max(1, len(images) // len(sources))
+        for n, source in enumerate(sources):
+            files = [getattr(image, 'already_saved_as', None) for image in images[n * per_source:(n + 1) * per_source]]
+            self.write({"completed": source, "files": files})
+
+    def close(self):
+        self.file.close()
+
+
+outputs_manifest_filename = "batchscripts_outputs.jsonl"
+
+
+class OutputWriterPool:
+    """Saves the generated images in background threads, so the generation does not wait on encoding and disk.
+    Images go through webui's save_image (format, embedded parameters, callbacks) under webui's file name pattern,
+    numbered up front as concurrent saves can't each look for the next free number, and batchscripts_outputs.jsonl
+    links every file to the source entry of its job.
+    submit blocks while the queue is full."""
+
+    def __init__(self, p, threads, queue_size=None):
+        from modules import images as img
+
+        self.path = p.outpath_samples
+        os.makedirs(self.path, exist_ok=True)
+        self.number = img.get_next_sequence_number(self.path, "")
+        self.lock = threading.Lock()
+        self.tasks = queue.Queue(queue_size or threads * 4)
+        self.errors = 0
+        self.manifest = open(os.path.join(self.path, outputs_manifest_filename), "a", encoding="utf8")
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, p, job, proc, on_saved=None):
+        # on_saved(job, images) is called from a writer thread once all the images of the job are saved
+        if not proc.images:
+            if on_saved is not None:
+                on_saved(job, proc.images)
+            return
+        pending = {'left': len(proc.images), 'failed': False, 'on_saved': on_saved}
+        for n in range(len(proc.images)):
+            seed = proc.all_seeds[n] if n < len(proc.all_seeds) else proc.seed
+            with self.lock:
+                number = self.number
+                self.number += 1
+            self.tasks.put((p, job, proc, n, seed, number, pending))
+
+    @staticmethod
+    def file_name(p, proc, n, seed, number):
+        # The name save_image would give the image (samples_filename_pattern, numbered unless disabled), with the
+        # number of the pool
+        from modules import images as img
+        from modules.shared import opts
+
+        pattern = opts.samples_filename_pattern or ("[seed]" if opts.save_to_dirs else "[seed]-[prompt_spaces]")
+        decoration = img.FilenameGenerator(p, seed, proc.all_prompts[n], proc.images[n]).apply(pattern)
+        if opts.save_images_add_number or decoration == '':
+            return f"{number:05}-{decoration}" if decoration else f"{number:05}"
+        return decoration
+
+    def work(self):
+        from modules import images as img
+        from modules.shared import opts
+
+        while (task := self.tasks.get()) is not None:
+            p, job, proc, n, seed, number, pending = task
+            sources = job.source if isinstance(job.source, list) else [job.source]
+            source = sources[min(n * len(sources) // len(proc.images), len(sources) - 1)]
+            name = f"{number:05}"
+            try:
+                name = self.file_name(p, proc, n, seed, number)
+                with tracer.span('save', name):
+                    filename, _ = img.save_image(proc.images[n], self.path, "", seed, proc.all_prompts[n],
+                                                 opts.samples_format, info=proc.infotexts[n], p=p,
+                                                 forced_filename=name)
+                proc.images[n].already_saved_as = filename
+                with self.lock:
+                    self.manifest.write(json.dumps({"file": filename, "source": source, "seed": seed},
+                                                   default=str) + "\n")
+            except Exception as e:
+                print(f"Could not save {name} of {source}: {e}")
+                with self.lock:
+                    self.errors += 1
+                    pending['failed'] = True
+
+            with self.lock:
+                pending['left'] -= 1
+                done = pending['left'] == 0 and not pending['failed']
+            if done and pending['on_saved'] is not None:
+                pending['on_saved'](job, proc.images)
+
+    def close(self):
+        # Waits for the queued images to be saved
+        for _ in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.manifest.close()
+        if self.errors:
+            print(f"{self.errors} images could not be saved, their jobs are not marked as completed.")
+
+
+def skip_unknown_checkpoints(jobs, fallback_checkpoint):
+    # Resolve the checkpoints of the jobs as they are planned, leaving out the jobs using a checkpoint that can't be
+    # found instead of stopping the batch when it gets to them
+    known = {}
+    skipped = {}
+    for job in jobs:
+        model = job.args.get('sd_model_hash')
+        if model is not None and model != fallback_checkpoint:
+            if model not in known:
+                known[model] = resolve_checkpoint(model) is not None
+                if not known[model]:
+                    print(f"Unknown checkpoint {model}, skipping the jobs using it (first: {job.source}).")
+            if not known[model]:
+                skipped[model] = skipped.get(model, 0) + 1
+                continue
+        yield job
+    if skipped:
+        print("Skipped jobs with an unknown checkpoint: " + ", ".join(f"{count} using {model}"
+                                                                      for model, count in skipped.items()) + ".")
+
+
+def process_jobs(p, jobs, options=BatchOptions(), key=None):
+    # Generate the Jobs as they are planned, in a background thread, and return the combined result.
+    # Completed jobs are recorded in the journal of the batch identified by key, see Journal.
+    # Jobs without a model hash run with the checkpoint loaded at the start, which is restored at the end.
+    # With a gallery limit, images are saved as they are produced (by an OutputWriterPool when webui is set not to
+    # save them), only thumbnails of the most recent ones are returned and the infotexts are appended to a JSONL file
+    # next to the outputs.
+    # With writer threads, images are saved by an OutputWriterPool and jobs complete once their images are saved.
+    from modules import shared
+    from modules.processing import Processed
+    from modules.processing import process_images
+    from modules.shared import state
+
+    scan_dates(options)
+    refresh_checkpoint_index()
+    if options.plan_only:
+        return dry_run(p, jobs, options, key)
+
+    fallback_checkpoint = shared.opts.sd_model_checkpoint
+    streaming = options.gallery_limit > 0
+    prefetcher = CheckpointPrefetcher(options.prefetch_budget)
+    planned_groups = deque()  # (model, upcoming) of the groups the scheduler started, ahead of generation
+
+    def plan_group(model, upcoming):
+        planned_groups.append((model, upcoming))
+
+    def next_group(model):
+        # Checkpoint of the group that runs after the group of model: the next one the scheduler started, or its
+        # best guess at the time, or the checkpoint restored at the end
+        while planned_groups and planned_groups[0][0] != model:
+            planned_groups.popleft()
+        if len(planned_groups) > 1:
+            upcoming = planned_groups[1][0]
+        elif planned_groups and planned_groups[0][1]:
+            upcoming = planned_groups[0][1][0]
+        else:
+            upcoming = None
+        return fallback_checkpoint if upcoming is None else upcoming
+
+    images = deque(maxlen=int(options.gallery_limit) if streaming else None)
+    all_prompts = deque(maxlen=images.maxlen)
+    infotexts = deque(maxlen=images.maxlen)
+    current = None
+    switches = 0
+
+    run_started = time.perf_counter()
+    if options.trace:
+        os.makedirs(p.outpath_samples, exist_ok=True)
+    tracer.start(os.path.join(p.outpath_samples, trace_filename) if options.trace else None)
+
+    key = key or run_key(p.prompt)
+    shard, shards = shard_options(options)
+    manifest = None
+    if shards > 1:
+        key = run_key(key, shard, shards)
+        manifest = ShardManifest(p, shard, shards, key, options.resume)
+
+    journal = Journal(key, options.resume, p)
+    index = OutputIndex(p, fallback_checkpoint) if options.dedup else None
+    progress = Progress(p, state)
+
+    infotexts_file = None
+    if streaming:
+        p.do_not_save_samples = False
+        os.makedirs(p.outpath_samples, exist_ok=True)
+        infotexts_file = open(os.path.join(p.outpath_samples, infotexts_filename), "a", encoding="utf8")
+
+    writer_threads = int(options.writer_threads)
+    if streaming and not shared.opts.samples_save:
+        # webui wouldn't save the images and the gallery only keeps thumbnails: the pool saves them instead
+        print("Images kept in the gallery are limited but webui is set not to save images, saving them anyway.")
+        writer_threads = max(writer_threads, 1)
+    elif not shared.opts.samples_save or p.do_not_save_samples:
+        writer_threads = 0
+    writer = OutputWriterPool(p, writer_threads) if writer_threads > 0 else None
+
+    def complete(job, job_images, duration):
+        journal.complete(job.ids)
+        if index is not None:
+            index.record(job.ids, job_images, duration)
+        if manifest is not None:
+            manifest.record(job, job_images)
+
+    try:
+        if manifest is not None:
+            jobs = manifest.plan(jobs)
+        jobs = skip_unknown_checkpoints(jobs, fallback_checkpoint)
+        jobs = journal.track(jobs)
+        if index is not None:
+            jobs = index.filter(jobs, journal)
+        jobs = run_in_background(progress.track(jobs))
+        first = True
+        for model, job in schedule_jobs(jobs, p, options, fallback_checkpoint, plan_group):
+            if state.interrupted:
+                break
+
+            if model != current or first:
+                checkpoint = fallback_checkpoint if model is None else model
+                if model != current:
+                    # a read of another checkpoint would compete with the load, a read of this one speeds it up
+                    prefetcher.cancel_other(checkpoint)
+                    with tracer.span('switch', str(model)):
+                        apply_checkpoint(checkpoint)
+                    current = model
+                    switches += 1
+                upcoming = next_group(model)
+                if upcoming != checkpoint:
+                    prefetcher.prefetch(upcoming)
+                first = False
+
+            state.job = f"{state.job_no + 1} out of {state.job_count}"
+
+            copy_p = copy.copy(p)
+            for k, v in job.args.items():
+                setattr(copy_p, k, v)
+
+            copy_p.override_settings = job.override_settings
+            copy_p.override_settings_restore_afterwards = True
+            copy_p.extra_generation_params = {}
+            if writer is not None:
+                copy_p.do_not_save_samples = True
+
+            started = time.perf_counter()
+            with tracer.span('generate', source=job.source, images=job.images(copy_p)):
+                proc = process_images(copy_p)
+            duration = time.perf_counter() - started
+
+            with tracer.span('results'):
+                if not state.interrupted:
+                    progress.done(job, duration)
+                if writer is not None:
+                    on_saved = None if state.interrupted else functools.partial(complete, duration=duration)
+                    writer.submit(copy_p, job, proc, on_saved)
+                elif not state.interrupted:
+                    complete(job, proc.images, duration)
+
+                if streaming:
+                    for image in proc.images:
+                        image = image.copy()
+                        image.thumbnail(thumbnail_size)
+                        images.append(image)
+                    for n, infotext in enumerate(proc.infotexts):
+                        seed = proc.all_seeds[n] if n < len(proc.all_seeds) else proc.seed
+                        infotexts_file.write(json.dumps({"prompt": proc.all_prompts[n], "seed": seed,
+                                                         "infotext": infotext}) + "\n")
+                    infotexts_file.flush()
+                else:
+                    images += proc.images
+
+                all_prompts += proc.all_prompts
+                infotexts += proc.infotexts
+    finally:
+        prefetcher.cancel()
+        if current is not None:
+            apply_checkpoint(fallback_checkpoint)
+        if writer is not None:
+            writer.close()
+        journal.close()
+        if index is not None:
+            index.close()
+        if manifest is not None:
+            manifest.close()
+        if infotexts_file is not None:
+            infotexts_file.close()
+        tracer.close()
+        print(tracer.summary(time.perf_counter() - run_started))
+        if progress.done_cost > 0:
+            record_timings(progress.generation_time, progress.done_cost, tracer.totals['switch'], switches)
+
+    return Processed(p, list(images), p.seed, "", all_prompts=list(all_prompts), infotexts=list(infotexts))
+
+
+def dry_run(p, jobs, options=BatchOptions(), key=None):
+    # Plan the whole batch without generating anything: print the run order as checkpoint groups, the estimated
+    # runtime and the checkpoints that can't be found, and return the plan as the info of an empty result.
+    from modules import shared
+    from modules.processing import Processed
+
+    fallback_checkpoint = shared.opts.sd_model_checkpoint
+    rate, per_switch, runs = calibrated_timings()
+
+    def numbered(jobs):
+        # packed jobs count their entries by their ids, which the journal gives otherwise
+        for n, job in enumerate(jobs):
+            job.ids = [str(n)]
+            yield job
+
+    key = key or run_key(p.prompt)
+    shard, shards = shard_options(options)
+    loads = None
+    if shards > 1:
+        key = run_key(key, shard, shards)
+        jobs, loads = shard_jobs(jobs, p, shard, shards)
+
+    journal = Journal(key, resume=True, p=p) if options.resume else None
+    jobs = journal.track(jobs) if journal is not None else numbered(jobs)
+
+    used = {}
+    groups = []
+    current = None
+    switches = 0
+    stats = {}
+    try:
+        for model, job in schedule_jobs(jobs, p, options, fallback_checkpoint, stats=stats):
+            if not groups or model != current:
+                if model != current:
+                    switches += 1
+                current = model
+                groups.append({'model': model, 'jobs': 0, 'images': 0, 'hires': 0, 'cost': 0.0})
+
+            name = fallback_checkpoint if model is None else model
+            count, source = used.get(name, (0, job.source[0] if isinstance(job.source, list) else job.source))
+            used[name] = (count + len(job.ids), source)
+
+            group = groups[-1]
+            group['jobs'] += len(job.ids)
+            group['images'] += job.images(p)
+            group['hires'] += len(job.ids) if job.args.get('enable_hr', p.enable_hr) else 0
+            group['cost'] += job_cost(job.args, p)
+    finally:
+        if journal is not None:
+            journal.close()
+    if current is not None:
+        switches += 1  # back to the checkpoint loaded at the start
+
+    resolved = {name: info.title if info is not None else None for name, info in resolve_checkpoints(used).items()}
+    unknown = {name: used[name] for name, title in resolved.items() if title is None}
+    cost = sum(group['cost'] for group in groups)
+    estimate = cost * rate + switches * per_switch
+    calibration = f"calibrated from {runs} past runs" if runs else "defaults, no past run to calibrate from"
+    lines = [f"Plan: {sum(g['jobs'] for g in groups)} jobs, {sum(g['images'] for g in groups)} images, "
+             f"{sum(g['hires'] for g in groups)} hires jobs, {len(groups)} checkpoint groups, {switches} switches.",
+             f"{'#':>5}  {'checkpoint':<48}{'jobs':>8}{'images':>8}{'hires':>8}{'est. time':>12}"]
+    for n, group in enumerate(groups[:plan_rows], 1):
+        name = fallback_checkpoint if group['model'] is None else group['model']
+        title = resolved.get(name) or f"{name} (unknown)"
+        duration = datetime.timedelta(seconds=round(group['cost'] * rate))
+        lines.append(f"{n:>5}  {title[:47]:<48}{group['jobs']:>8}{group['images']:>8}{group['hires']:>8}"
+                     f"{str(duration):>12}")
+    if len(groups) > plan_rows:
+        lines.append(f"       ... {len(groups) - plan_rows} more groups")
+    lines.append(f"Estimated runtime: {datetime.timedelta(seconds=round(estimate))} ({rate:.3f} s per megapixel-step "
+                 f"and {per_switch:.1f} s per checkpoint switch, {calibration}).")
+    if stats.get('conditioning_jobs'):
+        jobs_count = stats['conditioning_jobs']
+        lines.append(f"Prompt conditioning cache: expected hit rate {stats['conditioning_hits'] / jobs_count:.0%}, "
+                     f"{jobs_count - stats['conditioning_hits']} text encodings for {jobs_count} jobs "
+                     f"({stats['conditioning_hits_in_order'] / jobs_count:.0%} hit rate in list order).")
+    if loads is not None:
+        lines.append(f"Shard {shard} of {shards}, estimated runtime of the shards: " +
+                     ", ".join(str(datetime.timedelta(seconds=round(load * rate))) for load in loads) + ".")
+    if unknown:
+        lines.append(f"{len(unknown)} unknown checkpoints, their jobs would be skipped:")
+        lines += [f"  {name}: {count} jobs, first entry: {source}" for name, (count, source) in unknown.items()]
+    if options.dedup:
+        lines.append("Jobs already generated are not looked up in a plan, the estimate includes them.")
+
+    plan = "\n".join(lines)
+    print(plan)
+    return Processed(p, [], p.seed, plan, all_prompts=[], infotexts=[])
+
+
+upload_spool_threshold = 1024 * 1024  # uploads larger than this stay on the server instead of filling the textbox
+upload_preview_entries = 3
+spooled_uploads = set()  # files written by load_prompt_file, removed when another upload replaces them or at exit
+
+
+@atexit.register
+def remove_spooled_uploads():
+    for path in list(spooled_uploads):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def summarize_source(path, blocks=False):
+    entries = 0
+    models = set()
+    preview = []
+    for entry in iter_file_blocks(path) if blocks else iter_file_lines(path):
+        entries += 1
+        if blocks:
+            models.add(parse_infotext(entry).get('Model hash'))
+        if len(preview) < upload_preview_entries:
+            preview.append(entry)
+
+    summary = [f"Large upload kept on the server as {path}", f"{entries} entries"]
+    if blocks:
+        summary[-1] += f", {len(models - {None})} distinct models, about {entries} images at batch size 1"
+    summary += ["", "First entries:", ""]
+    return "\n".join(summary) + ("\n\n" if blocks else "\n").join(preview)
+
+
+def load_prompt_file(file, blocks=False, previous=''):
+    # previous is the server side source file of the UI, deleted if it is an upload this replaces. A batch still
+    # reading it keeps its open file.
+    import gradio as gr
 
-def load_prompt_file(file):
     if file is None:
-        return None, gr.update(), gr.update(lines=7)
+        return None, gr.update(), gr.update(lines=7), gr.update()
+
+    if previous in spooled_uploads:
+        spooled_uploads.discard(previous)
+        try:
+            os.remove(previous)
+        except OSError:
+            pass
+
+    if len(file) > upload_spool_threshold:
+        fd, path = tempfile.mkstemp(prefix="batchscripts-", suffix=".txt")
+        spooled_uploads.add(path)
+        with os.fdopen(fd, "wb") as f:
+            f.write(file)
+        return None, summarize_source(path, blocks), gr.update(lines=7), path
     else:
         lines = [x.strip() for x in file.decode('utf8', errors='ignore').split("\n")]
-        return None, "\n".join(lines), gr.update(lines=7)
+        return None, "\n".join(lines), gr.update(lines=7), ""
+
 
+def ui(script: 'scripts.Script', blocks=False):
+    import gradio as gr
 
-def ui(script: scripts.Script):
     script_overrides = gr.CheckboxGroup(label="Overrides", choices=possible_overrides, value=default_overrides)
     with gr.Accordion(label="Prompt overrides", open=False):
         prepend_prompt_text = gr.Textbox(label="Text to prepend", lines=1,
                                          elem_id=script.elem_id("prepend_prompt_text"))
         append_prompt = gr.Checkbox(label="Append text instead", elem_id=script.elem_id("append_prompt"))
 
+    with gr.Accordion(label="Batch options", open=False):
+        reader_threads = gr.Slider(label="Metadata reader threads", minimum=1, maximum=32, step=1, value=8,
+                                   elem_id=script.elem_id("reader_threads"))
+        lookahead = gr.Slider(label="Model grouping lookahead", minimum=1, maximum=1024, step=1, value=64,
+                              elem_id=script.elem_id("lookahead"))
+        gallery_limit = gr.Slider(label="Images kept in the gallery (0 = all, otherwise only recent thumbnails)",
+                                  minimum=0, maximum=1000, step=1, value=0, elem_id=script.elem_id("gallery_limit"))
+        max_batch_size = gr.Slider(label="Pack jobs differing only by seed up to this batch size", minimum=1,
+                                   maximum=16, step=1, value=1, elem_id=script.elem_id("max_batch_size"))
+        prefetch_budget = gr.Slider(label="Prefetch the next checkpoint up to this size (MB, 0 = disabled)",
+                                    minimum=0, maximum=32768, step=256, value=0,
+                                    elem_id=script.elem_id("prefetch_budget"))
+        with gr.Row():
+            scan_extensions = gr.Textbox(label="Extensions of the images in listed folders and patterns",
+                                         value='.png, .jpg, .jpeg, .webp', elem_id=script.elem_id("scan_extensions"))
+            scan_depth = gr.Number(label="Folder depth (0 = unlimited)", value=0, precision=0,
+                                   elem_id=script.elem_id("scan_depth"))
+        with gr.Row():
+            scan_after = gr.Textbox(label="Only images modified after (YYYY-MM-DD)",
+                                    elem_id=script.elem_id("scan_after"))
+            scan_before = gr.Textbox(label="Only images modified before (YYYY-MM-DD)",
+                                     elem_id=script.elem_id("scan_before"))
+        keep_order = gr.Checkbox(label="Keep the list order within a checkpoint group", value=False,
+                                 elem_id=script.elem_id("keep_order"))
+        resume = gr.Checkbox(label="Resume: skip the jobs already completed by a previous run of the same batch",
+                             value=False, elem_id=script.elem_id("resume"))
+        dedup = gr.Checkbox(label="Skip jobs already generated with the same parameters and checkpoint", value=False,
+                            elem_id=script.elem_id("dedup"))
+        with gr.Row():
+            shard_index = gr.Number(label="Run shard", value=1, precision=0, elem_id=script.elem_id("shard_index"))
+            shard_count = gr.Number(label="of shards (to split the batch across webui instances)", value=1,
+                                    precision=0, elem_id=script.elem_id("shard_count"))
+        plan_only = gr.Checkbox(label="Plan only: read the whole list and print the execution plan and estimated "
+                                      "runtime, without generating", value=False, elem_id=script.elem_id("plan_only"))
+        writer_threads = gr.Slider(label="Image writer threads (0 = webui saves the images between jobs)", minimum=0,
+                                   maximum=16, step=1, value=0, elem_id=script.elem_id("writer_threads"))
+        trace = gr.Checkbox(label=f"Write a timeline of the run to {trace_filename} in the output folder", value=False,
+                            elem_id=script.elem_id("trace"))
+        invalidate_cache = gr.Button(value="Invalidate parameters cache", elem_id=script.elem_id("invalidate_cache"))
+        invalidate_cache.click(fn=invalidate_parameters_cache, inputs=[], outputs=[], show_progress=False)
+
     prompt_txt = gr.Textbox(label="List of prompt inputs", lines=1, elem_id=script.elem_id("prompt_txt"))
     file = gr.File(label="Upload prompt inputs", type='binary', elem_id=script.elem_id("file"))
+    with gr.Row():
+        source_file = gr.Textbox(label="Or read the inputs from this file on the server", lines=1,
+                                 elem_id=script.elem_id("source_file"))
+        entry_start = gr.Number(label="First entry", value=0, precision=0, elem_id=script.elem_id("entry_start"))
+        entry_stop = gr.Number(label="Stop before entry (0 = last)", value=0, precision=0,
+                               elem_id=script.elem_id("entry_stop"))
+
+    file.change(fn=lambda f, previous: load_prompt_file(f, blocks, previous), inputs=[file, source_file],
+                outputs=[file, prompt_txt, prompt_txt, source_file], show_progress=False)
 
-    file.change(fn=load_prompt_file, inputs=[file], outputs=[file, prompt_txt, prompt_txt], show_progress=False)
 
     # We start at one line. When the text changes, we jump to seven lines, or two lines if no \n.
     # We don't shrink back to 1, because that causes the control to ignore [enter], and it may
     # be unclear to the user that shift-enter is needed.
     prompt_txt.change(lambda tb: gr.update(lines=7) if ("\n" in tb) else gr.update(lines=2), inputs=[prompt_txt],
                       outputs=[prompt_txt], show_progress=False)
-    return [prepend_prompt_text, append_prompt, prompt_txt, script_overrides]
+    return [prepend_prompt_text, append_prompt, prompt_txt, script_overrides, reader_threads, lookahead, gallery_limit,
+            max_batch_size, prefetch_budget, keep_order, resume, dedup, source_file, entry_start, entry_stop,
+            scan_extensions, scan_depth, scan_after, scan_before, trace, plan_only, shard_index, shard_count,
+            writer_threads]